@@ -0,0 +1,84 @@
+"""
+Micro-benchmark of the duplicate grouping of phoso.cull
+
+Compares extract_duplicates and common_hashes with the list based versions
+they replaced, on synthetic hash lists.
+
+    python benchmarks/bench_duplicates.py 100000 1000000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from phoso.cull import common_hashes, extract_duplicates
+
+
+def legacy_extract_duplicates(hash_pairs):
+    sorted_hash = sorted(hash_pairs, key=lambda x: x[3])
+    duplicates = []
+    i = 1
+    while i < len(sorted_hash):
+        if sorted_hash[i][3] == sorted_hash[i-1][3]:
+            duplicates.append(sorted_hash.pop(i))
+        else:
+            i += 1
+    return sorted_hash, duplicates
+
+
+def legacy_common_hashes(source_hashes, destination_hashes):
+    destination_h = [x[3] for x in destination_hashes]
+    commons = []
+    n_source = len(source_hashes)
+    for i in range(n_source):
+        i_source = n_source - i - 1
+        if source_hashes[i_source][3] in destination_h:
+            commons.append(source_hashes.pop(i_source))
+    return source_hashes, commons
+
+
+def make_hash_pairs(n, duplicate_ratio, seed=0):
+    rng = random.Random(seed)
+    n_unique = max(1, int(n * (1 - duplicate_ratio)))
+    hashes = ['%040x' % rng.getrandbits(160) for _ in range(n_unique)]
+    return [['/photos/%08d.jpg' % i, float(i), 1000, hashes[i] if i < n_unique else rng.choice(hashes)]
+            for i in range(n)]
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('sizes', type=int, nargs='*', default=[100000, 1000000],
+                        help='number of entries of the hash lists')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.2)
+    parser.add_argument('--legacy-max', type=int, default=100000,
+                        help='largest size the legacy versions are run on, they are quadratic')
+    args = parser.parse_args()
+
+    print('%10s %-20s %10s %10s %8s' % ('entries', 'function', 'legacy s', 'new s', 'speedup'))
+    for n in args.sizes:
+        hash_pairs = make_hash_pairs(n, args.duplicate_ratio)
+        # common_hashes against a destination of 1000 entries
+        destination = make_hash_pairs(1000, 0, seed=1) + hash_pairs[:1000]
+
+        for name, legacy, new, call_args in [
+                ('extract_duplicates', legacy_extract_duplicates, extract_duplicates, (hash_pairs,)),
+                ('common_hashes', legacy_common_hashes, common_hashes, (hash_pairs, destination))]:
+            t_new = timed(new, *[list(a) for a in call_args])
+            if n <= args.legacy_max:
+                t_legacy = timed(legacy, *[list(a) for a in call_args])
+                print('%10d %-20s %10.3f %10.3f %7.1fx' % (n, name, t_legacy, t_new, t_legacy / t_new))
+            else:
+                print('%10d %-20s %10s %10.3f %8s' % (n, name, '-', t_new, '-'))
+
+
+if __name__ == '__main__':
+    main()
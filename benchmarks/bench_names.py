@@ -0,0 +1,56 @@
+"""
+Speed of phoso.classify.NameClassifier on file names
+
+Classifies a mix of phone, video, raw and camera file names, as
+`phoso.sort.file_metadata` does for each file, and reports names/s.
+
+    python benchmarks/bench_names.py 1000000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from phoso.classify import DEFAULT_CLASSIFIER
+
+
+def make_names(n, seed=0):
+    rng = random.Random(seed)
+    names = []
+    for i in range(n):
+        day = '%04d%02d%02d' % (rng.randint(1990, 2025), rng.randint(1, 12), rng.randint(1, 28))
+        hms = '%02d%02d%02d' % (rng.randint(0, 23), rng.randint(0, 59), rng.randint(0, 59))
+        names.append([
+            'WP_%s_%03d.mp4' % (day, i % 1000),
+            'VID_%s_%s.mp4' % (day, hms),
+            'IMG_%s_%s.jpg' % (day, hms),
+            '%s_%s.mp4' % (day, hms),
+            'P%07d.rw2' % (i % 10000000),
+            'DSC%05d.JPG' % (i % 100000),
+            'TRIM_%s_%s.3gp' % (day, hms),
+        ][i % 7])
+    return names
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('sizes', type=int, nargs='*', default=[1000000],
+                        help='number of names')
+    args = parser.parse_args()
+
+    classify = DEFAULT_CLASSIFIER.classify
+    print('%10s %10s %12s' % ('names', 's', 'names/s'))
+    for n in args.sizes:
+        names = make_names(n)
+        start = time.perf_counter()
+        for name in names:
+            classify(name)
+        elapsed = time.perf_counter() - start
+        print('%10d %10.3f %12.0f' % (n, elapsed, n / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""
+Benchmark of the phoso hot paths on a synthetic library
+
+Each stage runs in its own forked process so that its peak RSS is measured
+on its own. Results can be saved as JSON and compared with a previous run.
+
+    python benchmarks/bench_phoso.py --files 5000 --size-kb 200 --json new.json --compare old.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(__file__))
+from phoso.cull import cull, extract_duplicates, hash_tree
+from phoso.exif import exif_batch
+from phoso.sort import sortphotos
+from phoso.utils import general_case_exif, match_files
+from synth import generate
+
+EXTENSIONS = ['jpg', 'mp4', 'rw2']
+
+
+def _tree_files(root):
+    return match_files(root, [r'.*\.{}'.format(ext) for ext in EXTENSIONS])
+
+
+def _nbytes(paths):
+    return sum(os.path.getsize(p) for p in paths)
+
+
+# each stage takes (library, workdir), does its setup and returns
+# (callable to time, number of files, number of bytes)
+
+def stage_match_files(library, workdir):
+    files = _tree_files(library)
+    return (lambda: _tree_files(library)), len(files), 0
+
+
+def stage_general_case_exif(library, workdir):
+    files = [f for f in _tree_files(library) if f.lower().endswith('.jpg')]
+
+    def run():
+        for f in files:
+            general_case_exif(f, '/opt/bin/exif')
+    return run, len(files), 0
+
+
+def stage_exif_batch(library, workdir):
+    files = [f for f in _tree_files(library) if f.lower().endswith('.jpg')]
+    return (lambda: exif_batch(files, '/opt/bin/exif')), len(files), 0
+
+
+def stage_hash_tree(library, workdir):
+    files = _tree_files(library)
+    return (lambda: hash_tree(library, verbose=False)), len(files), _nbytes(files)
+
+
+def stage_extract_duplicates(library, workdir):
+    hashes = hash_tree(library, verbose=False)
+    return (lambda: extract_duplicates(hashes)), len(hashes), 0
+
+
+def stage_sortphotos(library, workdir):
+    files = _tree_files(library)
+    dest = os.path.join(workdir, 'sorted')
+    os.makedirs(dest)
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            sortphotos(library, dest, EXTENSIONS, '%Y/%m', False, True, False, True)
+    return run, len(files), _nbytes(files)
+
+
+def stage_cull(library, workdir):
+    files = _tree_files(library)
+    index = os.path.join(workdir, 'hashes.sqlite')
+    return (lambda: cull(library, index, dry_run=True)), len(files), _nbytes(files)
+
+
+STAGES = {
+    'match_files': stage_match_files,
+    'general_case_exif': stage_general_case_exif,
+    'exif_batch': stage_exif_batch,
+    'hash_tree': stage_hash_tree,
+    'extract_duplicates': stage_extract_duplicates,
+    'sortphotos': stage_sortphotos,
+    'cull': stage_cull,
+}
+
+
+def _run_stage(name, library, conn):
+    workdir = tempfile.mkdtemp(prefix='phoso-bench-')
+    try:
+        run, n_files, n_bytes = STAGES[name](library, workdir)
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        # ru_maxrss is in kB on linux
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        conn.send({'stage': name, 'seconds': elapsed, 'files': n_files,
+                   'bytes': n_bytes, 'peak_rss': peak_rss})
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        conn.close()
+
+
+def run_stage(name, library):
+    '''
+    Run a stage in a forked process, returns its measurements
+    '''
+    ctx = multiprocessing.get_context('fork')
+    parent_conn, child_conn = ctx.Pipe()
+    proc = ctx.Process(target=_run_stage, args=(name, library, child_conn))
+    proc.start()
+    result = parent_conn.recv()
+    proc.join()
+    result['files_per_s'] = result['files'] / result['seconds'] if result['seconds'] else 0
+    result['mb_per_s'] = result['bytes'] / 1e6 / result['seconds'] if result['seconds'] else 0
+    return result
+
+
+def report(results, baseline=None):
+    baseline = {r['stage']: r for r in (baseline or [])}
+    header = '%-20s %8s %9s %11s %9s %9s' % ('stage', 'files', 'seconds', 'files/s', 'MB/s', 'RSS MB')
+    if baseline:
+        header += ' %9s' % 'vs base'
+    print(header)
+    for r in results:
+        line = '%-20s %8d %9.3f %11.1f %9.1f %9.1f' % (
+            r['stage'], r['files'], r['seconds'], r['files_per_s'], r['mb_per_s'], r['peak_rss'] / 1e6)
+        if r['stage'] in baseline:
+            line += ' %8.2fx' % (baseline[r['stage']]['seconds'] / r['seconds'])
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--library', type=str, default=None,
+                        help='existing library to use instead of generating one')
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--size-kb', type=float, default=100)
+    parser.add_argument('--duplicate-ratio', type=float, default=0.1)
+    parser.add_argument('--dirs', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stages', type=str, nargs='+', choices=list(STAGES), default=list(STAGES))
+    parser.add_argument('--json', type=str, default=None, help='save the results to this file')
+    parser.add_argument('--compare', type=str, default=None, help='results of a previous run to compare with')
+    args = parser.parse_args()
+
+    tmp = None
+    library = args.library
+    if library is None:
+        tmp = tempfile.mkdtemp(prefix='phoso-library-')
+        library = os.path.join(tmp, 'library')
+        generate(library, args.files, args.size_kb, args.duplicate_ratio, args.dirs, seed=args.seed)
+
+    try:
+        results = [run_stage(name, library) for name in args.stages]
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fobj:
+            baseline = json.load(fobj)['results']
+    report(results, baseline)
+
+    if args.json:
+        with open(args.json, 'w') as fobj:
+            json.dump({'args': vars(args), 'results': results}, fobj, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Memory and speed of phoso.cull.HashRecords against hash lists
+
+Builds a hash list as read back from a JSON hash list (lists of lists), and
+the same records in a HashRecords, and reports the memory of each measured
+with tracemalloc, and the time of extract_duplicates and common_hashes.
+
+    python benchmarks/bench_records.py 100000 1000000
+"""
+
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from phoso.cull import HashRecords, common_hashes, extract_duplicates
+
+
+def make_records(n, duplicate_ratio=0.2, n_dirs=2000, seed=0):
+    rng = random.Random(seed)
+    n_unique = max(1, int(n * (1 - duplicate_ratio)))
+    hashes = ['%040x' % rng.getrandbits(160) for _ in range(n_unique)]
+    records = []
+    for i in range(n):
+        path = '/share/photos/%04d/%02d/IMG_%08d.jpg' % (2000 + i % 25, i % n_dirs % 12 + 1, i)
+        fhash = hashes[i] if i < n_unique else rng.choice(hashes)
+        records.append([path, 1.5e9 + i, rng.randrange(1 << 24), fhash, 1.5e9 + i, 1000 + i])
+    # as read back from a JSON hash list
+    return json.loads(json.dumps(records))
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, current
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('sizes', type=int, nargs='*', default=[100000, 1000000],
+                        help='number of records')
+    args = parser.parse_args()
+
+    print('%10s %-10s %10s %14s %10s %10s' % ('records', 'store', 'MB', 'bytes/record',
+                                              'extract s', 'common s'))
+    for n in args.sizes:
+        destination = make_records(1000, seed=1)
+        lists, list_bytes = measure(lambda: make_records(n))
+        store, store_bytes = measure(lambda: HashRecords(lists))
+        for name, records, nbytes in [('lists', lists, list_bytes), ('HashRecords', store, store_bytes)]:
+            t_extract = timed(extract_duplicates, records)
+            source = list(records) if name == 'lists' else records.take(range(len(records)))
+            t_common = timed(common_hashes, source, destination)
+            print('%10d %-10s %10.1f %14.1f %10.3f %10.3f' % (
+                n, name, nbytes / 1e6, nbytes / n, t_extract, t_common))
+        print('%10d %-10s %9.1fx' % (n, 'reduction', list_bytes / store_bytes))
+        del lists, store
+
+
+if __name__ == '__main__':
+    main()
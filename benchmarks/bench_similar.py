@@ -0,0 +1,56 @@
+"""
+Speed of phoso.similar.similar_groups on image hashes
+
+Builds 64 bit hashes as dhash gives them: random images, some re-encoded
+(a few bits flipped) and some exact copies, and reports the time to cluster
+them.
+
+    python benchmarks/bench_similar.py 10000 100000 1000000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from phoso.similar import MAX_DISTANCE, similar_groups
+
+
+def make_records(n, near_ratio=0.1, copy_ratio=0.05, seed=0):
+    rng = random.Random(seed)
+    records = []
+    for i in range(n):
+        draw = rng.random()
+        if records and draw < copy_ratio:
+            value = rng.choice(records)[3]
+        elif records and draw < copy_ratio + near_ratio:
+            value = rng.choice(records)[3]
+            for bit in rng.sample(range(64), rng.randint(1, MAX_DISTANCE + 2)):
+                value ^= 1 << bit
+        else:
+            value = rng.getrandbits(64)
+        records.append(['/share/photos/IMG_%08d.jpg' % i, 1000 + i, 0.0, value, 12000000])
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('sizes', type=int, nargs='*', default=[10000, 100000, 1000000],
+                        help='number of images')
+    parser.add_argument('--distance', type=int, default=MAX_DISTANCE,
+                        help='largest Hamming distance of near-duplicates')
+    args = parser.parse_args()
+
+    print('%10s %10s %10s %12s' % ('images', 'clusters', 's', 'images/s'))
+    for n in args.sizes:
+        records = make_records(n)
+        start = time.perf_counter()
+        clusters = similar_groups(records, args.distance)
+        elapsed = time.perf_counter() - start
+        print('%10d %10d %10.3f %12.0f' % (n, len(clusters), elapsed, n / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""
+Synthetic photo library generator for the phoso benchmarks
+
+Writes a tree of files with the name patterns phoso handles:
+
+- jpg: DSC_NNNN.jpg with a real EXIF block (DateTimeOriginal, Model)
+- img: IMG_YYYYMMDD_HHMMSS.jpg, half of them with EXIF
+- vid: VID_YYYYMMDD_HHMMSS.mp4 with an ftyp and moov/mvhd header
+- wp: WP_YYYYMMDD_NNN.mp4
+- rw2: P100NNNN.RW2 with a TIFF header holding DateTime and Model
+
+A fraction of the files are exact copies of others, under another name in
+another directory.
+
+    python benchmarks/synth.py /tmp/library --files 10000 --size-kb 200
+"""
+
+import argparse
+import os
+import random
+import struct
+from datetime import datetime, timedelta
+
+MIX = {'jpg': 0.5, 'img': 0.2, 'vid': 0.1, 'wp': 0.1, 'rw2': 0.1}
+MODELS = ['Canon EOS 5D', 'NIKON D750', 'DMC-GX80', 'Pixel 7', 'iPhone 13']
+
+# seconds between 1904-01-01 (QuickTime epoch) and 1970-01-01
+QT_EPOCH = 2082844800
+
+
+def tiff_block(date, model, endian='<', magic=42):
+    '''
+    TIFF structure with IFD0 (Model, DateTime, Exif pointer) and an Exif IFD
+    (DateTimeOriginal, DateTimeDigitized)
+    '''
+    date_b = date.strftime('%Y:%m:%d %H:%M:%S').encode() + b'\x00'
+    model_b = model.encode() + b'\x00'
+    ifd0_off = 8
+    ifd0_len = 2 + 3*12 + 4
+    model_off = ifd0_off + ifd0_len
+    date_off = model_off + len(model_b)
+    exif_off = date_off + len(date_b)
+    exif_len = 2 + 2*12 + 4
+
+    ifd0 = struct.pack(endian + 'H', 3)
+    ifd0 += struct.pack(endian + 'HHII', 0x0110, 2, len(model_b), model_off)
+    ifd0 += struct.pack(endian + 'HHII', 0x0132, 2, len(date_b), date_off)
+    ifd0 += struct.pack(endian + 'HHII', 0x8769, 4, 1, exif_off)
+    ifd0 += struct.pack(endian + 'I', 0)
+    exif = struct.pack(endian + 'H', 2)
+    exif += struct.pack(endian + 'HHII', 0x9003, 2, len(date_b), exif_off + exif_len)
+    exif += struct.pack(endian + 'HHII', 0x9004, 2, len(date_b), exif_off + exif_len)
+    exif += struct.pack(endian + 'I', 0)
+
+    header = (b'II' if endian == '<' else b'MM') + struct.pack(endian + 'HI', magic, ifd0_off)
+    return header + ifd0 + model_b + date_b + exif + date_b
+
+
+def jpeg_bytes(payload, date=None, model=None):
+    data = b'\xff\xd8'
+    if date is not None:
+        app1 = b'Exif\x00\x00' + tiff_block(date, model)
+        data += b'\xff\xe1' + struct.pack('>H', len(app1) + 2) + app1
+    return data + b'\xff\xda' + payload + b'\xff\xd9'
+
+
+def box(kind, body):
+    return struct.pack('>I', len(body) + 8) + kind + body
+
+
+def mp4_bytes(payload, date):
+    seconds = int((date - datetime(1970, 1, 1)).total_seconds()) + QT_EPOCH
+    # version 0 mvhd: creation, modification, timescale, duration, then fixed fields
+    mvhd = struct.pack('>B3xIIII', 0, seconds, seconds, 1000, 1000) + b'\x00'*80
+    header = box(b'ftyp', b'isom\x00\x00\x02\x00isomiso2mp41')
+    return header + box(b'moov', box(b'mvhd', mvhd)) + box(b'mdat', payload)
+
+
+def rw2_bytes(payload, date, model):
+    # Panasonic raw files are TIFF structured with the magic number 0x55
+    return tiff_block(date, model, magic=0x55) + payload
+
+
+def make_file(kind, idx, date, payload, rng):
+    model = rng.choice(MODELS)
+    if kind == 'jpg':
+        return 'DSC_%05d.jpg' % idx, jpeg_bytes(payload, date, model)
+    if kind == 'img':
+        exif = rng.random() < 0.5
+        return ('IMG_%s.jpg' % date.strftime('%Y%m%d_%H%M%S'),
+                jpeg_bytes(payload, date if exif else None, model))
+    if kind == 'vid':
+        return 'VID_%s.mp4' % date.strftime('%Y%m%d_%H%M%S'), mp4_bytes(payload, date)
+    if kind == 'wp':
+        return 'WP_%s_%03d.mp4' % (date.strftime('%Y%m%d'), idx % 1000), mp4_bytes(payload, date)
+    if kind == 'rw2':
+        return 'P10%05d.RW2' % idx, rw2_bytes(payload, date, model)
+    raise ValueError('unknown kind {}'.format(kind))
+
+
+def generate(root, n_files=1000, size_kb=100, duplicate_ratio=0.1, n_dirs=20,
+             mix=None, seed=0):
+    '''
+    Write a synthetic library under root
+
+    Args:
+        root: output directory, created if needed
+        n_files: number of files, duplicates included
+        size_kb: mean file size in kB, sizes are spread from half to 1.5 times this
+        duplicate_ratio: fraction of the files that are copies of other files
+        n_dirs: number of subdirectories the files are spread over
+        mix: {kind: weight} of the name patterns, see MIX
+        seed: seed of the random generator
+
+    Returns the list of written paths
+    '''
+    rng = random.Random(seed)
+    mix = mix or MIX
+    kinds, weights = zip(*mix.items())
+    start = datetime(2010, 1, 1)
+    os.makedirs(root, exist_ok=True)
+
+    paths = []
+    contents = []
+    for idx in range(n_files):
+        subdir = os.path.join(root, 'dir%03d' % rng.randrange(n_dirs))
+        os.makedirs(subdir, exist_ok=True)
+        if contents and rng.random() < duplicate_ratio:
+            fname, data = rng.choice(contents)
+            fname = 'copy%05d_%s' % (idx, fname)
+        else:
+            kind = rng.choices(kinds, weights)[0]
+            date = start + timedelta(seconds=rng.randrange(10*365*24*3600))
+            size = int(size_kb * 1024 * rng.uniform(0.5, 1.5))
+            fname, data = make_file(kind, idx, date, rng.randbytes(size), rng)
+            contents.append((fname, data))
+        path = os.path.join(subdir, fname)
+        # burst shots may share a name, keep the first one
+        if os.path.exists(path):
+            path = os.path.join(subdir, '%05d_%s' % (idx, fname))
+        with open(path, 'wb') as fobj:
+            fobj.write(data)
+        paths.append(path)
+    return paths
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        kind, weight = item.split('=')
+        mix[kind.strip()] = float(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('root', type=str, help='output directory')
+    parser.add_argument('--files', type=int, default=1000)
+    parser.add_argument('--size-kb', type=float, default=100)
+    parser.add_argument('--duplicate-ratio', type=float, default=0.1)
+    parser.add_argument('--dirs', type=int, default=20)
+    parser.add_argument('--mix', type=parse_mix, default=None,
+                        help='weights of the name patterns, e.g. jpg=0.5,img=0.2,vid=0.1,wp=0.1,rw2=0.1')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    paths = generate(args.root, args.files, args.size_kb, args.duplicate_ratio,
+                     args.dirs, args.mix, args.seed)
+    print('wrote {} files to {}'.format(len(paths), args.root))
+
+
+if __name__ == '__main__':
+    main()
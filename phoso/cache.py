@@ -0,0 +1,170 @@
+"""
+cache.py
+
+Persistent cache of the (date, model, date_fail) metadata of files, so that
+repeated sort runs over the same files skip EXIF extraction.
+
+Entries are keyed by path and validated with the size and mtime of the file.
+A file moved to another directory under the same name is still found by its
+name, inode, size and mtime. A renamed file is read again, since its
+metadata may come from its name, see `phoso.classify`. The cache is bounded: the least recently used
+entries are evicted on commit.
+
+The cache lives in an SQLite table and can share its database file with a
+`phoso.index.HashIndex`, so one file can serve the sort and cull tools.
+Paths are stored as in the index, see `phoso.index.encode_path`.
+"""
+
+import logging
+import os
+import threading
+from datetime import datetime
+
+from .index import connect, encode_path
+
+LOGGER = logging.getLogger(__name__)
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS metadata (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    inode INTEGER,
+    variant TEXT,
+    date TEXT,
+    model TEXT,
+    date_fail INTEGER,
+    used INTEGER
+);
+CREATE INDEX IF NOT EXISTS metadata_inode ON metadata (inode);
+CREATE INDEX IF NOT EXISTS metadata_used ON metadata (used);
+'''
+
+
+def _stat(src_file):
+    if isinstance(src_file, os.DirEntry):
+        return src_file.stat()
+    return os.stat(src_file)
+
+
+class MetadataCache:
+    """
+    LRU cache of file metadata stored in SQLite
+
+    Args:
+        path: database file, may be the file of a HashIndex
+        max_entries: number of entries kept after `commit`
+        variant: results are only reused for the same variant, e.g. the exif
+            backend, since backends may not agree on a file
+    """
+
+    def __init__(self, path, max_entries=1000000, variant=''):
+        self.path = os.path.expanduser(path)
+        self.max_entries = max_entries
+        self.variant = variant
+        self.conn = connect(self.path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(_SCHEMA)
+        self.lock = threading.Lock()
+        # every run uses the entries it touches with a new generation
+        self.generation = (self.conn.execute('SELECT MAX(used) FROM metadata').fetchone()[0] or 0) + 1
+        self.touched = []
+        # records of put_many, written by commit
+        self.pending = []
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, path, stat):
+        row = self.conn.execute(
+            'SELECT path, size, mtime, variant, date, model, date_fail FROM metadata '
+            'WHERE path = CAST(? AS TEXT)', (encode_path(path),)).fetchone()
+        if row is None or (row[1], row[2], row[3]) != (stat.st_size, stat.st_mtime, self.variant):
+            # moved file. Its name must be the same: the metadata may come
+            # from a name rule, and inodes of other devices may be equal
+            name = os.path.basename(path)
+            rows = self.conn.execute(
+                'SELECT path, size, mtime, variant, date, model, date_fail FROM metadata '
+                'WHERE inode = ? AND size = ? AND mtime = ? AND variant = ?',
+                (stat.st_ino, stat.st_size, stat.st_mtime, self.variant))
+            row = next((r for r in rows if os.path.basename(r[0]) == name), None)
+        return row
+
+    def get_many(self, src_files):
+        """
+        Cached metadata of the files that are unchanged since they were cached
+
+        Args:
+            src_files: paths or os.DirEntry
+
+        Returns:
+            dict {path: (date, model, date_fail)} of the cache hits
+        """
+        stats = []
+        for src_file in src_files:
+            try:
+                stats.append((os.fspath(src_file), _stat(src_file)))
+            except OSError:
+                continue
+        hits = {}
+        with self.lock:
+            for path, stat in stats:
+                row = self._lookup(path, stat)
+                if row is None:
+                    self.misses += 1
+                    continue
+                self.hits += 1
+                self.touched.append(row[0])
+                hits[path] = (datetime.fromisoformat(row[4]), row[5], bool(row[6]))
+        return hits
+
+    def put_many(self, items):
+        """
+        Add entries, written to the database on `commit`
+
+        Args:
+            items: list of (src_file, (date, model, date_fail)), src_file being
+                a path or an os.DirEntry
+        """
+        records = []
+        for src_file, (date, model, date_fail) in items:
+            try:
+                stat = _stat(src_file)
+            except OSError:
+                continue
+            records.append((encode_path(src_file), stat.st_size, stat.st_mtime, stat.st_ino,
+                            self.variant, date.isoformat(), model, int(date_fail), self.generation))
+        with self.lock:
+            self.pending.extend(records)
+
+    def commit(self):
+        """
+        Write the entries added and record the use of the entries hit since
+        the last commit, evict the least recently used entries beyond
+        max_entries and commit
+
+        Writes only happen here, so that a thread reading ahead with
+        `get_many` and `put_many` does not hold a write transaction on a
+        database shared with a HashIndex written by another thread.
+        """
+        with self.lock:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO metadata '
+                '(path, size, mtime, inode, variant, date, model, date_fail, used) '
+                'VALUES (CAST(? AS TEXT), ?, ?, ?, ?, ?, ?, ?, ?)', self.pending)
+            self.pending = []
+            self.conn.executemany('UPDATE metadata SET used = ? WHERE path = CAST(? AS TEXT)',
+                                  ((self.generation, encode_path(p)) for p in self.touched))
+            self.touched = []
+            n_entries = self.conn.execute('SELECT COUNT(*) FROM metadata').fetchone()[0]
+            if n_entries > self.max_entries:
+                self.conn.execute(
+                    'DELETE FROM metadata WHERE path IN '
+                    '(SELECT path FROM metadata ORDER BY used LIMIT ?)',
+                    (n_entries - self.max_entries,))
+            self.conn.commit()
+
+    def close(self):
+        self.commit()
+        LOGGER.info('Metadata cache: %s hits, %s misses', self.hits, self.misses)
+        self.conn.close()
@@ -0,0 +1,164 @@
+"""
+classify.py
+
+Dates and camera models found in file names, e.g. IMG_20140904_101010.jpg
+from Android phones or WP_20140904_001.mp4 from Windows phones.
+
+Each naming scheme is a `NameRule`: a regular expression searched in the
+file name, whose named groups Y, m, d and optionally H, M, S hold the date.
+The rules for each extension are compiled in a single alternation, tried in
+order, so a name is classified with one search, and the date is built from
+the integers of the groups rather than parsed with strptime.
+
+More rules can be given in a JSON file, a list of objects with the fields of
+`NameRule`, which are tried before the built-in ones:
+
+    [{"name": "pixel", "pattern": "^PXL_(?P<Y>[0-9]{4})(?P<m>[0-9]{2})(?P<d>[0-9]{2})_",
+      "model": "Pixel", "exif": true, "extensions": ["jpg"]}]
+"""
+
+import hashlib
+import json
+import logging
+import re
+from collections import namedtuple
+from datetime import datetime
+
+LOGGER = logging.getLogger(__name__)
+
+DATE_FIELDS = ('Y', 'm', 'd', 'H', 'M', 'S')
+
+NameRule = namedtuple('NameRule', ['name', 'pattern', 'model', 'exif', 'extensions'],
+                      defaults=[False, None])
+NameRule.__doc__ = '''
+Naming scheme of files
+
+Args:
+    name: name of the rule, for the logs
+    pattern: regular expression searched in the file name, with named groups
+        Y, m, d, and optionally H, M, S, for the date. ^ and $ anchor it to
+        the start and end of the name
+    model: camera model of the matching files
+    exif: read the date and model from EXIF first. The name gives the date
+        and model when EXIF has none. Without date groups, the EXIF (or
+        modification time) date is used with model as the default model
+    extensions: extensions, after the last period and case sensitive, of the
+        names the rule is tried on, None to try it on every name
+'''
+
+BUILTIN_RULES = [
+    NameRule('wp', r'WP_(?P<Y>[0-9]{4})(?P<m>[0-9]{2})(?P<d>[0-9]{2})_[0-9]{3}\.mp4$', 'WP',
+             extensions=['mp4']),
+    NameRule('vid', r'(?:VID|TRIM)_(?P<Y>[0-9]{4})(?P<m>[0-9]{2})(?P<d>[0-9]{2})_'
+             r'(?P<H>[0-9]{2})(?P<M>[0-9]{2})(?P<S>[0-9]{2})\.(?:mp4|mkv|3gp)$', 'video',
+             extensions=['mp4', 'mkv', '3gp']),
+    NameRule('img', r'IMG_(?P<Y>[0-9]{4})(?P<m>[0-9]{2})(?P<d>[0-9]{2})_'
+             r'(?P<H>[0-9]{2})(?P<M>[0-9]{2})(?P<S>[0-9]{2})\.(?:jpg|JPG)$', 'img', True,
+             extensions=['jpg', 'JPG']),
+    NameRule('mp4', r'(?P<Y>[12][890][0-9]{2})(?P<m>[0-9]{2})(?P<d>[0-9]{2})_'
+             r'(?P<H>[012][0-9])(?P<M>[0-6][0-9])(?P<S>[0-6][0-9])\.mp4$', 'video',
+             extensions=['mp4']),
+    NameRule('rw2', r'.\.rw2$', 'raw', True, extensions=['rw2']),
+]
+
+_r_group = re.compile(r'\(\?P<([A-Za-z_][A-Za-z0-9_]*)>')
+
+# integers of the digit strings of dates, a dict lookup is faster than int()
+_NUMBERS = {}
+for _i in range(10000):
+    _NUMBERS['%04d' % _i] = _i
+for _i in range(100):
+    _NUMBERS['%02d' % _i] = _NUMBERS[str(_i)] = _i
+_number = _NUMBERS.__getitem__
+
+
+def _rule_pattern(idx, rule):
+    '''
+    Pattern of the rule as the group r<idx> of an alternation, its date
+    groups renamed r<idx>_Y... so that rules can use the same names
+    '''
+    fields = _r_group.findall(rule.pattern)
+    if any(f not in DATE_FIELDS for f in fields) or \
+            (fields and not {'Y', 'm', 'd'}.issubset(fields)):
+        raise ValueError('rule {}: named groups must be Y, m, d and optionally H, M, S'.format(rule.name))
+    if not fields and not rule.exif:
+        raise ValueError('rule {}: a rule without date groups must use exif'.format(rule.name))
+    prefix = 'r{}_'.format(idx)
+    pattern = _r_group.sub(lambda mo: '(?P<{}{}>'.format(prefix, mo.group(1)), rule.pattern)
+    try:
+        re.compile(pattern)
+    except re.error as ex:
+        raise ValueError('rule {}: {}'.format(rule.name, ex))
+    return '(?P<r{}>{})'.format(idx, pattern), [prefix + f for f in DATE_FIELDS if f in fields]
+
+
+class NameClassifier:
+    """
+    Rules compiled in one regular expression per extension, with the rules
+    for this extension in order, so that a name is searched once
+
+    Raises ValueError for an invalid rule
+    """
+
+    def __init__(self, rules=BUILTIN_RULES):
+        self.rules = [NameRule(*rule) for rule in rules]
+        patterns = [_rule_pattern(idx, rule) for idx, rule in enumerate(self.rules)]
+
+        # extension -> (regex, {group of a rule: (rule, group numbers of its date fields)})
+        # the key None holds the rules for any extension
+        self._by_ext = {}
+        compiled = {}
+        extensions = {ext for rule in self.rules for ext in rule.extensions or []}
+        for ext in [None] + sorted(extensions):
+            todo = tuple(idx for idx, rule in enumerate(self.rules)
+                         if rule.extensions is None or ext in rule.extensions)
+            if todo not in compiled:
+                compiled[todo] = self._compile(todo, patterns) if todo else (None, {})
+            self._by_ext[ext] = compiled[todo]
+
+        custom = [list(r) for r in self.rules if r not in BUILTIN_RULES]
+        # tells results of different rules apart, e.g. in a metadata cache
+        self.key = hashlib.sha1(json.dumps(custom).encode()).hexdigest()[:8] if custom else ''
+
+    def _compile(self, todo, patterns):
+        regex = re.compile('|'.join(patterns[idx][0] for idx in todo))
+        groups = {'r{}'.format(idx): (self.rules[idx],
+                                      tuple(regex.groupindex[n] for n in patterns[idx][1]))
+                  for idx in todo}
+        return regex, groups
+
+    def classify(self, name):
+        '''
+        Returns (rule, date): the first rule matching the file name, or None,
+        and the date of the name, None if the rule has no date groups
+        '''
+        regex, groups = self._by_ext.get(name.rpartition('.')[2]) or self._by_ext[None]
+        mo = regex.search(name) if regex is not None else None
+        if mo is None:
+            return None, None
+        rule, numbers = groups[mo.lastgroup]
+        if not numbers:
+            return rule, None
+        try:
+            try:
+                return rule, datetime(*map(_number, mo.group(*numbers)))
+            except KeyError:
+                return rule, datetime(*map(int, mo.group(*numbers)))
+        except ValueError:
+            # not a date, e.g. month 13
+            return None, None
+
+
+def load_rules(path):
+    '''
+    Rules of a JSON file followed by the built-in rules
+
+    Returns a list of NameRule
+    '''
+    with open(path) as fobj:
+        rules = [NameRule(**rule) for rule in json.load(fobj)]
+    LOGGER.info('%s file name rules from %s', len(rules), path)
+    return rules + BUILTIN_RULES
+
+
+DEFAULT_CLASSIFIER = NameClassifier()
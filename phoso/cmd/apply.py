@@ -0,0 +1,40 @@
+import argparse
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from ..metrics import RunMetrics
+from ..plan import apply_plan
+
+def main():
+
+    # setup command line parsing
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+                                     description='Apply a plan file written by phoso.cmd.sort or phoso.cmd.cull with --plan')
+    parser.add_argument('plan', type=str, help='path to the plan file')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of workers, actions of a destination directory keep their order')
+    parser.add_argument('--shard', type=int, default=0,
+                        help='only apply the actions of this shard, from 0 to SHARDS-1')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='number of shards the plan is split into, by destination directory')
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='append progress events and a per-stage timing summary to this JSON-lines file')
+
+    # parse command line arguments
+    args = parser.parse_args()
+
+    # SETUP LOGGING
+    logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
+
+    executor = ThreadPoolExecutor(max_workers=args.jobs) if args.jobs > 1 else None
+    metrics = RunMetrics(progress=sys.stdout, events=args.metrics)
+    apply_plan(args.plan, executor, shard=args.shard, n_shards=args.shards, metrics=metrics)
+    if executor is not None:
+        executor.shutdown()
+    metrics.summary()
+
+
+if __name__ == '__main__':
+    main()
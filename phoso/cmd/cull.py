@@ -4,7 +4,10 @@ import os
 import sys
 from datetime import datetime
 
-from ..cull import cull
+from ..cull import DEFAULT_HASH, HASHES, KEEPERS, cull
+from ..metrics import RunMetrics
+from ..shard import hash_shard
+from ..similar import MAX_DISTANCE, near_duplicates
 
 def main():
 
@@ -13,7 +16,33 @@ def main():
                                      description='Cull a directory of all duplicates using a hash list')
     parser.add_argument('root', type=str,
                         help='root directory (searched recursively)')
-    parser.add_argument('hash_list', type=str, help='Path to hash_list')
+    parser.add_argument('hash_list', type=str, help='Path to hash index, a JSON hash_list is imported on first use')
+    parser.add_argument('--keep', type=str, choices=list(KEEPERS), default='first',
+                        help='copy kept in each group of duplicates: first path, oldest ctime or shortest path')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='hash root into the index and report the duplicates, without deleting any file')
+    parser.add_argument('--plan', type=str, default=None,
+                        help='write the deletions to this plan file instead, see phoso.cmd.apply')
+    parser.add_argument('--resume', action='store_true',
+                        help='finish the deletions of an interrupted run without scanning root again.\n\
+Hashes are always kept in the index as they are computed')
+    parser.add_argument('--similar', type=int, nargs='?', const=MAX_DISTANCE, default=None, metavar='DISTANCE',
+                        help='report near-duplicate images (re-saved, resized or re-encoded) instead of identical files.\n\
+Images whose 64 bit perceptual hashes differ by at most DISTANCE bits (default {}) are\n\
+clustered. Nothing is deleted, use --plan to review and apply the suggested deletions.\n\
+Needs Pillow'.format(MAX_DISTANCE))
+    parser.add_argument('--shard', type=str, nargs='?', const='', default=None, metavar='NAME',
+                        help='only hash every file of root into hash_list, a shard index named NAME\n\
+(defaults to the host name), to be merged with the shards of other hosts by phoso.cmd.merge')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of threads hashing files, or decoding images with --similar, defaults to 1')
+    parser.add_argument('--hash', type=str, choices=list(HASHES), default=DEFAULT_HASH,
+                        help='digest used to compare files, defaults to {}. Files hashed with another\n\
+digest are hashed again when compared. xxh128 needs the xxhash package'.format(DEFAULT_HASH))
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='append progress events and a per-stage timing summary to this JSON-lines file')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='do not print the progress line')
 
     # parse command line arguments
     args = parser.parse_args()
@@ -31,7 +60,17 @@ def main():
     # fo = open(os.path.join('.', error_log_file), 'w')
     # sys.stderr = fo
 
-    cull(args.root, args.hash_list)
+    metrics = RunMetrics(progress=None if args.quiet else sys.stdout, events=args.metrics)
+    if args.shard is not None:
+        hash_shard(args.root, args.hash_list, name=args.shard or None, metrics=metrics,
+                   jobs=args.jobs, algorithm=args.hash)
+    elif args.similar is not None:
+        near_duplicates(args.root, args.hash_list, max_distance=args.similar, jobs=args.jobs,
+                        plan_file=args.plan, metrics=metrics)
+    else:
+        cull(args.root, args.hash_list, dry_run=args.dry_run, keep=args.keep, plan_file=args.plan,
+             metrics=metrics, jobs=args.jobs, algorithm=args.hash, resume=args.resume)
+    metrics.summary()
 
 
 if __name__ == '__main__':
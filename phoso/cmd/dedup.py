@@ -0,0 +1,50 @@
+import argparse
+import logging
+import os
+import sys
+
+from ..cull import DEFAULT_HASH, HASHES, dedup_incoming
+from ..metrics import RunMetrics
+
+def main():
+
+    # setup command line parsing
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+                                     description='Find the files of an incoming directory (memory card, phone dump)\n\
+that are already in an archive, using the hash index of the archive')
+    parser.add_argument('src_dir', type=str,
+                        help='incoming directory (searched recursively)')
+    parser.add_argument('hash_list', type=str,
+                        help='hash index of the archive, see phoso.cmd.cull. The archive is not scanned')
+    parser.add_argument('--action', type=str, choices=['report', 'delete', 'hold'], default='report',
+                        help='what to do with the archived files: only report them (default),\n\
+delete them or move them to --hold-dir')
+    parser.add_argument('--hold-dir', type=str, default=None,
+                        help='holding directory for --action hold, recreates the dir structure')
+    parser.add_argument('--plan', type=str, default=None,
+                        help='write the actions to this plan file instead, see phoso.cmd.apply')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of threads hashing files, defaults to 1')
+    parser.add_argument('--hash', type=str, choices=list(HASHES), default=DEFAULT_HASH,
+                        help='digest used to compare files, defaults to {}'.format(DEFAULT_HASH))
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='append progress events and a per-stage timing summary to this JSON-lines file')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='do not print the progress line')
+
+    # parse command line arguments
+    args = parser.parse_args()
+    if args.action == 'hold' and args.hold_dir is None:
+        parser.error('--action hold needs --hold-dir')
+
+    # SETUP LOGGING
+    logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
+
+    metrics = RunMetrics(progress=None if args.quiet else sys.stdout, events=args.metrics)
+    dedup_incoming(args.src_dir, args.hash_list, action=args.action, hold_dir=args.hold_dir,
+                   plan_file=args.plan, metrics=metrics, jobs=args.jobs, algorithm=args.hash)
+    metrics.summary()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+import argparse
+import logging
+import os
+import sys
+
+from ..cull import KEEPERS
+from ..metrics import RunMetrics
+from ..shard import merge_shards
+
+def main():
+
+    # setup command line parsing
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+                                     description='Find the duplicates across shard indexes built with phoso.cmd.cull --shard,\n\
+and write the deletions of each shard to its own plan file')
+    parser.add_argument('shards', type=str, nargs='+', help='paths to the shard indexes')
+    parser.add_argument('--plan-dir', type=str, default='.',
+                        help='directory of the plan files, one <shard name>.plan per shard,\n\
+to be applied on each host with phoso.cmd.apply. Defaults to the current directory')
+    parser.add_argument('--keep', type=str, choices=list(KEEPERS), default='first',
+                        help='copy kept in each group of duplicates: first shard given then first path,\n\
+oldest ctime or shortest path')
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='append progress events and a per-stage timing summary to this JSON-lines file')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='do not print the progress line')
+
+    # parse command line arguments
+    args = parser.parse_args()
+
+    # SETUP LOGGING
+    logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
+
+    metrics = RunMetrics(progress=None if args.quiet else sys.stdout, events=args.metrics)
+    merge_shards(args.shards, args.plan_dir, keep=args.keep, metrics=metrics)
+    metrics.summary()
+
+
+if __name__ == '__main__':
+    main()
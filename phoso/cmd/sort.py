@@ -4,8 +4,21 @@ import os
 import sys
 from datetime import datetime
 
+from ..classify import load_rules
+from ..metrics import RunMetrics
 from ..sort import sortphotos
+from ..transfer import METHODS
 from ..utils import del_dirs
+from ..watch import SETTLE, Watch
+
+
+def _until_interrupted(batches):
+    # Ctrl-C while waiting for files ends the run normally
+    try:
+        yield from batches
+    except KeyboardInterrupt:
+        return
+
 
 def main():
 
@@ -39,10 +52,47 @@ The default is '%%Y/%%m', which separates by year then month (e.g., 2012/11).")
     parser.add_argument('--keep-filenames', action='store_true',
                         help='Do not rename the files. Default behavior is to rename the files, e.g. 2014-09-04_FinePix_1.jpg')
     parser.add_argument('--exif-path', type=str, default='/opt/bin/exif',
-                        help='path to use for the terminal exif command, defaults to /opt/bin/exif')
+                        help='exif program: a path containing exiftool runs exiftool once per batch of files,\n\
+any other value reads EXIF in process. Defaults to /opt/bin/exif')
+    parser.add_argument('--name-rules', type=str, default=None,
+                        help='JSON file of rules giving the date and model of files from their names,\n\
+tried before the built-in rules, see phoso.classify')
+    parser.add_argument('--hash-index', type=str, default=None,
+                        help='hash index of dest_dir (see phoso.cmd.cull) used to find duplicates anywhere in dest_dir')
+    parser.add_argument('--metadata-cache', type=str, default=None,
+                        help='cache of the dates and models of the source files, reused by the next runs.\n\
+May be the same file as --hash-index')
+    parser.add_argument('--transfer', type=str, choices=METHODS, default='copy',
+                        help="how files are copied: copy (in-kernel copy), reflink (copy-on-write clone) or hardlink.\n\
+rename moves the files like --move. Falls back to copy when not supported.")
+    parser.add_argument('--plan', type=str, default=None,
+                        help='only plan: write the actions to this plan file instead of moving files, see phoso.cmd.apply')
+    parser.add_argument('--journal', type=str, default='phoso_sort.journal',
+                        help='file recording the transferred files, deleted at the end of the run,\n\
+defaults to phoso_sort.journal in the current directory')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip the files transferred by an interrupted run, according to the journal')
+    parser.add_argument('--watch', action='store_true',
+                        help='after sorting src_dir, keep running and sort the new files as they arrive, until Ctrl-C.\n\
+Uses inotify on Linux, polling elsewhere. Directories are not deleted in this mode')
+    parser.add_argument('--settle', type=float, default=SETTLE,
+                        help='with --watch, seconds a new file must stay unchanged before it is sorted, defaults to %(default)s')
+    parser.add_argument('--poll', type=float, default=None,
+                        help='with --watch, scan src_dir every POLL seconds instead of using inotify')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of workers for metadata extraction and file transfer, defaults to 1')
+    parser.add_argument('--read-ahead', type=int, default=0,
+                        help='number of chunks whose metadata is read while the current one is transferred,\n\
+useful on network mounts. Defaults to 0')
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='append progress events and a per-stage timing summary to this JSON-lines file')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='do not print the progress line')
 
     # parse command line arguments
     args = parser.parse_args()
+    if args.watch and args.plan is not None:
+        parser.error('--watch transfers the files, it cannot be used with --plan')
 
     # SETUP LOGGING
     now = datetime.now().strftime('%Y%m%d-%H%M%S')
@@ -50,21 +100,43 @@ The default is '%%Y/%%m', which separates by year then month (e.g., 2012/11).")
     logging.basicConfig(filename=os.path.join('.', log_file),
                         level=logging.DEBUG, format='%(asctime)s %(message)s')
 
-    # setup logging from stderr
+    # errors also go to their own log
     error_log_file = "log_error_{}.log".format(now)
-    fo = open(os.path.join('.', error_log_file), 'w')
-    sys.stderr = fo
+    error_handler = logging.FileHandler(os.path.join('.', error_log_file))
+    error_handler.setLevel(logging.WARNING)
+    logging.getLogger().addHandler(error_handler)
+
+    metrics = RunMetrics(progress=None if args.quiet else sys.stdout, events=args.metrics)
 
+    # started first, so that files arriving during the first run are not missed
+    watch = Watch(args.src_dir, args.extensions, settle=args.settle,
+                  poll_interval=args.poll) if args.watch else None
+
+    options = dict(rename=not args.keep_filenames, exif_path=args.exif_path, hold_dir=args.hold_dir,
+                   jobs=args.jobs, hash_index=args.hash_index, transfer=args.transfer,
+                   metrics=metrics, metadata_cache=args.metadata_cache,
+                   name_rules=load_rules(args.name_rules) if args.name_rules else None)
     sortphotos(args.src_dir, args.dest_dir, args.extensions, args.sort,
-               args.move, not args.keep_duplicates, args.ignore_exif, rename=not args.keep_filenames, exif_path=args.exif_path, hold_dir=args.hold_dir)
+               args.move, not args.keep_duplicates, args.ignore_exif, plan_file=args.plan,
+               read_ahead=args.read_ahead, journal=args.journal, resume=args.resume, **options)
+
+    if watch is not None:
+        try:
+            sortphotos(args.src_dir, args.dest_dir, args.extensions, args.sort,
+                       args.move, not args.keep_duplicates, args.ignore_exif,
+                       batches=_until_interrupted(watch.batches()), **options)
+        finally:
+            watch.close()
 
     # If requested, remove all empty directories from source
-    if args.delete_dir or args.force_delete_dir:
+    if args.plan is None and not args.watch and (args.delete_dir or args.force_delete_dir):
         # First delete the annoying thumbnail folders
         # del_dirs(args.src_dir, match='.@__thumb')
         # delete the rest
         del_dirs(args.src_dir, force=args.force_delete_dir)
 
+    metrics.summary()
+
 
 if __name__ == '__main__':
     main()
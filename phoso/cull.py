@@ -1,5 +1,5 @@
 #! /usr/bin/python
-from hashlib import sha1
+from hashlib import blake2b, sha1
 import os
 import os.path
 import sys
@@ -7,9 +7,46 @@ import logging
 import json
 from json.decoder import JSONDecodeError
 import copy
+from array import array
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+from .index import HashIndex, open_index
+from .metrics import NULL_METRICS
+from .plan import PlanWriter, apply_actions, read_plan
+from .transfer import temp_name
+from .utils import scan_tree
 
 LOGGER = logging.getLogger(__name__)
 
+# bytes read at each end of a file before deciding to hash it completely
+EDGE_SIZE = 16*1024
+
+# digests for the full hash of files. Digests other than sha1 are stored with
+# their name as prefix, e.g. 'blake2b:...', so that digests of different
+# algorithms are never compared. With OpenSSL sha1 is usually the fastest
+# cryptographic one, xxh128 (non-cryptographic, needs the xxhash package) is
+# several times faster.
+HASHES = {
+    'sha1': sha1,
+    'blake2b': lambda: blake2b(digest_size=20),
+}
+if xxhash is not None:
+    HASHES['xxh128'] = xxhash.xxh3_128
+DEFAULT_HASH = 'sha1'
+
+# files hashed between two calls of the on_hashed callback of fill_hashes
+HASH_BATCH = 256
+
+# duplicates deleted between two commits of the hash index by cull
+DELETE_BATCH = 1000
+
 def read_hash(path='~/.phoso/hashes.json'):
     # Read existing hashes from hash_list
     LOGGER.info('Reading %s', path)
@@ -23,80 +60,378 @@ def read_hash(path='~/.phoso/hashes.json'):
 
 
 def write_hash(hashes, path='~/.phoso/hashes.json'):
-    with open(path, 'w') as fobj:
+    # written under a temporary name then renamed, a crash keeps the old list
+    tmp_path = temp_name(path)
+    with open(tmp_path, 'w') as fobj:
         json.dump(hashes, fobj, indent=4)
+    os.replace(tmp_path, path)
 
 
-def hash_tree(base_dir, fsize_max=500.*1e6, verbose=True, already_hashed=[]):
+def file_hash(path, buffer_size=1 << 20, algorithm=DEFAULT_HASH):
+    """
+    Digest of a file, streamed through a fixed size buffer, see HASHES
+    """
+    h = HASHES[algorithm]()
+    buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as fobj:
+        while True:
+            n = fobj.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+    if algorithm == DEFAULT_HASH:
+        return h.hexdigest()
+    return algorithm + ':' + h.hexdigest()
+
+
+def hash_algorithm(fhash):
+    """
+    Name of the algorithm of a digest returned by `file_hash`
     """
-    Given a base directory traverse the whole tree and calc all the sha1 hash
+    algorithm, sep, _ = fhash.partition(':')
+    return algorithm if sep else DEFAULT_HASH
 
-    Returns a list of hashes
-    [[abspath, ctime, fsize, fhash]...]
+
+def edge_hash(path, fsize, edge_size=EDGE_SIZE):
+    """
+    sha1 of the first and last `edge_size` bytes of a file
+    """
+    with open(path, 'rb') as fobj:
+        h = sha1(fobj.read(edge_size))
+        fobj.seek(max(fsize - edge_size, edge_size))
+        h.update(fobj.read(edge_size))
+    return h.hexdigest()
+
+
+def _disk_order(hash_pair):
+    # files of a directory are usually laid out on disk in inode order
+    inode = hash_pair[5] if len(hash_pair) > 5 and hash_pair[5] is not None else 0
+    return os.path.dirname(hash_pair[0]), inode
+
+
+def _try_hash(func, path, *args):
+    try:
+        return func(path, *args)
+    except OSError as ex:
+        LOGGER.info('Could not read %s: %s', path, ex)
+        return None
+
+
+def _map(executor, func, *iterables):
+    if executor is None:
+        return map(func, *iterables)
+    return executor.map(func, *iterables)
+
+
+def fill_hashes(hash_pairs, edge_size=EDGE_SIZE, verbose=True, metrics=NULL_METRICS,
+                jobs=1, algorithm=DEFAULT_HASH, on_hashed=None, hash_all=False):
+    """
+    Compute the hash of every file that may have a duplicate, in place
+
+    Stage 1 groups the files by size, a file with a unique size has no
+    duplicate and is not read at all. Stage 2 hashes the first and last
+    `edge_size` bytes of the files sharing a size, and stage 3 computes the
+    full streamed hash of the files that still collide. Files that are not
+    hashed keep a hash of None. Hashes of another algorithm than `algorithm`
+    are computed again when needed.
+
+    Files are read in directory then inode order, to keep reads sequential
+    on spinning disks. With jobs > 1, files are read and hashed by a pool of
+    threads, hashlib releases the GIL while hashing.
+
+    Parameters
+    ----------
+    hash_pairs: list
+        [[abspath, ctime, fsize, fhash, ...]...], entries are updated in place
+    metrics: RunMetrics
+        collects the 'edge_hash' and 'hash' stages and reports progress
+    jobs: int
+        number of threads reading and hashing files
+    algorithm: str
+        digest of the full hash, one of HASHES
+    on_hashed: callable
+        if not None, called with lists of the entries hashed since the last
+        call, as they are hashed
+    hash_all: bool
+        fully hash every file, skipping stages 1 and 2, for hash lists
+        compared with other lists, see `phoso.shard`
+
+    Returns
+    -------
+    count: int
+        number of files fully hashed
     """
     report_every = 50
     count = 0
-    hash_pairs = []
-    abspaths = [x[0] for x in already_hashed]
-    for d, subdirs, files in os.walk(base_dir):
-        for fname in files:
-            abspath = os.path.abspath(os.path.join(d, fname))
-            ctime = os.path.getctime(abspath)
-            fsize = os.path.getsize(abspath)
-            fhash = None
-
-            if abspath not in abspaths:
-                if fsize < fsize_max:
-                    with open(abspath, 'rb') as fobj:
-                        fhash = sha1(fobj.read()).hexdigest()
+
+    def needs_hash(hash_pair):
+        return hash_pair[3] is None or hash_algorithm(hash_pair[3]) != algorithm
+
+    by_size = defaultdict(list)
+    for hash_pair in hash_pairs:
+        by_size[hash_pair[2]].append(hash_pair)
+    groups = [(fsize, group) for fsize, group in by_size.items()
+              if (hash_all or len(group) > 1) and any(needs_hash(x) for x in group)]
+
+    def use_edges(fsize):
+        return not hash_all and fsize > 2*edge_size
+
+    executor = ThreadPoolExecutor(max_workers=jobs) if jobs > 1 else None
+    try:
+        # stage 2, small files are read whole by the full hash anyway
+        edge_todo = sorted((x for fsize, group in groups if use_edges(fsize) for x in group),
+                           key=_disk_order)
+        with metrics.timer('edge_hash'):
+            edges = list(_map(executor, _try_hash, repeat(edge_hash), (x[0] for x in edge_todo),
+                              (x[2] for x in edge_todo), repeat(edge_size)))
+        metrics.add('edge_hash', sum(e is not None for e in edges), 2*edge_size*len(edge_todo))
+        edge_of = {id(x): e for x, e in zip(edge_todo, edges)}
+
+        candidates = []
+        for fsize, group in groups:
+            if use_edges(fsize):
+                by_edge = defaultdict(list)
+                for hash_pair in group:
+                    if edge_of[id(hash_pair)] is not None:
+                        by_edge[edge_of[id(hash_pair)]].append(hash_pair)
+                candidates += [x for g in by_edge.values() if len(g) > 1 for x in g]
+            else:
+                candidates += group
+
+        # stage 3, results are used as they arrive
+        todo = sorted((x for x in candidates if needs_hash(x)), key=_disk_order)
+        n_todo = len(todo)
+        done_bytes = 0
+        hashed = []
+        with metrics.timer('hash'):
+            results = _map(executor, _try_hash, repeat(file_hash), (x[0] for x in todo),
+                           repeat(1 << 20), repeat(algorithm))
+            for idx, (hash_pair, fhash) in enumerate(zip(todo, results), 1):
+                if fhash is not None:
+                    hash_pair[3] = fhash
+                    metrics.add('hash', 1, hash_pair[2])
+                    done_bytes += hash_pair[2]
+                    hashed.append(hash_pair)
                     if verbose:
                         if count % report_every == 0:
                             LOGGER.debug("Hashing file %s", count+1)
-                else:
-                    if verbose:
-                        LOGGER.info(
-                            'Skipped file %s due to size', abspath)
+                    count += 1
+                if on_hashed is not None and len(hashed) >= HASH_BATCH:
+                    on_hashed(hashed)
+                    hashed = []
+                metrics.progress(idx, n_todo, done_bytes)
+        if on_hashed is not None and hashed:
+            on_hashed(hashed)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return count
+
+
+def is_unchanged(hash_pair, stat):
+    """
+    True if the entry still describes the file with the given os.stat result.
+    Entries of older hash lists without mtime and inode only compare the size.
+    """
+    if hash_pair[2] != stat.st_size:
+        return False
+    if len(hash_pair) < 6 or hash_pair[4] is None:
+        return True
+    return hash_pair[4] == stat.st_mtime and hash_pair[5] == stat.st_ino
+
+
+def hash_tree(base_dir, verbose=True, already_hashed=None, metrics=NULL_METRICS, jobs=1,
+              algorithm=DEFAULT_HASH, hash_all=False):
+    """
+    Given a base directory traverse the whole tree and calc the sha1 hash of
+    every file that may have a duplicate, see `fill_hashes`.
+
+    The run is incremental: an entry of already_hashed whose size, mtime and
+    inode are unchanged is reused, modified files are hashed again and
+    entries of files inside base_dir that no longer exist are pruned.
+    already_hashed is updated in place: pruned and modified entries are
+    removed, reused entries are hashed if a new file shares their size.
+
+    already_hashed may be a HashIndex, in which case only the entries sharing
+    a size with a new file are loaded, and the new entries as well as the
+    updated ones are written to the index.
+
+    With an index, hashes are written and committed as they are computed,
+    so that a killed run keeps them.
 
-                hash_pairs.append((abspath, ctime, fsize, fhash))
-                count += 1
+    metrics collects the 'scan' stage and those of `fill_hashes`, which
+    hashes with `jobs` threads and the `algorithm` digest. With hash_all,
+    every file is hashed, including those with a unique size, as needed
+    when the list is merged with lists of other trees, see `phoso.shard`.
 
+    Returns a list of hashes of the new and modified files
+    [[abspath, ctime, fsize, fhash, mtime, inode]...]
+    """
+    if already_hashed is None:
+        already_hashed = []
+    use_index = isinstance(already_hashed, HashIndex)
+    if use_index:
+        lookup = already_hashed.get
+        known_paths = already_hashed.paths_under(base_dir)
+    else:
+        by_path = {x[0]: x for x in already_hashed}
+        lookup = by_path.get
+        prefix = os.path.join(os.path.abspath(base_dir), '')
+        known_paths = [p for p in by_path if p.startswith(prefix)]
+
+    hash_pairs = []
+    upgraded = []
+    seen = set()
+    n_reused = 0
+    with metrics.timer('scan'):
+        for entry in scan_tree(os.path.abspath(base_dir)):
+            abspath = entry.path
+            stat = entry.stat()
+            seen.add(abspath)
+
+            cached = lookup(abspath)
+            if cached is not None and is_unchanged(cached, stat):
+                n_reused += 1
+                if len(cached) < 6 or cached[4] is None:
+                    upgraded.append(cached)
+                    cached[4:] = [stat.st_mtime, stat.st_ino]
+                continue
+
+            hash_pairs.append([abspath, stat.st_ctime, stat.st_size, None,
+                               stat.st_mtime, stat.st_ino])
+    metrics.add('scan', len(seen))
+
+    # entries to drop: files that vanished or were modified
+    pruned = [p for p in known_paths if p not in seen]
+    stale = set(pruned).union(x[0] for x in hash_pairs)
+
+    if use_index:
+        already_hashed.delete(stale)
+        sizes = {x[2] for x in hash_pairs}
+        related = [x for fsize in sizes for x in already_hashed.with_size(fsize)]
+        if hash_all:
+            related_paths = {x[0] for x in related}
+            related += [x for x in already_hashed.unhashed(base_dir) if x[0] not in related_paths]
+    else:
+        already_hashed[:] = [x for x in already_hashed if x[0] not in stale]
+        related = list(already_hashed)
+    unhashed = [x for x in related if x[3] is None]
+
+    on_hashed = None
+    if use_index:
+        def on_hashed(hashed):
+            already_hashed.upsert(hashed)
+            already_hashed.commit()
+
+    count = fill_hashes(related + hash_pairs, verbose=verbose, metrics=metrics, jobs=jobs,
+                        algorithm=algorithm, on_hashed=on_hashed, hash_all=hash_all)
+
+    if use_index:
+        already_hashed.upsert(upgraded)
+        already_hashed.upsert([x for x in unhashed if x[3] is not None])
+        already_hashed.upsert(hash_pairs)
+        already_hashed.commit()
+
+    LOGGER.info("Reused %s files, found %s new or modified files, pruned %s entries",
+                n_reused, len(hash_pairs), len(pruned))
     LOGGER.info("Hashed %s files", count)
     return hash_pairs
 
 
-def extract_duplicates(hash_pairs):
+# rules to choose the copy kept in a group of duplicates, as sort keys
+KEEPERS = {
+    'first': None,                          # first of the group
+    'oldest': lambda x: x[1],               # oldest ctime
+    'shortest': lambda x: (len(x[0]), x[0]),  # shortest path
+}
+
+
+def choose_keeper(group, keep='first'):
+    """
+    Split a group of duplicates into the copy to keep and the others
+
+    Parameters
+    ----------
+    group: list
+        hash_pairs sharing a hash
+    keep: str
+        rule from KEEPERS
+
+    Returns
+    -------
+    keeper: hash_pair
+    others: list
+    """
+    key = KEEPERS[keep]
+    i_keep = 0 if key is None else min(range(len(group)), key=lambda i: key(group[i]))
+    return group[i_keep], group[:i_keep] + group[i_keep+1:]
+
+
+def group_duplicates(hash_pairs):
+    """
+    Group hash_pairs by hash in a single pass
+
+    Returns
+    -------
+    groups: list
+        lists of hash_pairs sharing a hash, in input order. Files without
+        hash are never part of a group.
+    """
+    by_hash = defaultdict(list)
+    for hash_pair in hash_pairs:
+        if hash_pair[3] is not None:
+            by_hash[hash_pair[3]].append(hash_pair)
+    return [group for group in by_hash.values() if len(group) > 1]
+
+
+def extract_duplicates(hash_pairs, keep='first'):
     """
     Given a list of hash_pairs
 
     Parameters
     ----------
-    hash_pairs: list
+    hash_pairs: list or HashRecords
+    keep: str
+        rule from KEEPERS choosing the copy kept in each group
 
     Returns
     -------
-    sorted_hash: list
-        unique hash_pairs
+    unique_hash: list or HashRecords
+        unique hash_pairs, in input order
     duplicates: list
         hashed removed from the original hash_pairs list
     """
-    sorted_hash = sorted(hash_pairs, key=lambda x: x[3])
+    if isinstance(hash_pairs, HashRecords):
+        # only the records of the groups are built
+        duplicate_ids = set()
+        for group in hash_pairs.duplicate_groups():
+            if KEEPERS[keep] is None:
+                duplicate_ids.update(group[1:])
+                continue
+            records = [hash_pairs[i] for i in group]
+            keeper = choose_keeper(records, keep)[0]
+            duplicate_ids.update(i for i, x in zip(group, records) if x is not keeper)
+        unique_ids = [i for i in range(len(hash_pairs)) if i not in duplicate_ids]
+        return hash_pairs.take(unique_ids), [hash_pairs[i] for i in sorted(duplicate_ids)]
+
     duplicates = []
-    i = 1
-    while i < len(sorted_hash):
-        if sorted_hash[i][3] == sorted_hash[i-1][3]:
-            duplicates.append(sorted_hash.pop(i))
-        else:
-            i += 1
+    for group in group_duplicates(hash_pairs):
+        duplicates += choose_keeper(group, keep)[1]
+
+    duplicate_ids = {id(x) for x in duplicates}
+    unique_hash = [x for x in hash_pairs if id(x) not in duplicate_ids]
 
-    return sorted_hash, duplicates
+    return unique_hash, duplicates
 
 
-def purge_duplicates(base_dir):
+def purge_duplicates(base_dir, keep='first'):
     """
     Delete all duplicates in the directory tree
     """
     hashes = hash_tree(base_dir)
-    hashes, duplicates = extract_duplicates(hashes)
+    hashes, duplicates = extract_duplicates(hashes, keep)
 
     for hash_tuple in duplicates:
         os.remove(hash_tuple[0])
@@ -104,8 +439,214 @@ def purge_duplicates(base_dir):
     return hashes, duplicates
 
 
+class HashRecords:
+    """
+    Compact store of hash records, for hash lists of millions of files
+
+    Records are kept in columns: directories are interned and stored once,
+    file names in a list, ctime, size, mtime and inode in arrays, and the
+    digests as a single bytearray of binary digests (20 bytes for sha1
+    instead of a str of 40 characters). A record costs about a fifth of the
+    memory of a [abspath, ctime, fsize, fhash, mtime, inode] list.
+
+    Indexing or iterating builds records as such lists, so a HashRecords can
+    be read where a hash list is expected. Changing these lists does not
+    change the store. Digests of another algorithm than `algorithm` are
+    stored as None, to be computed again.
+
+    Parameters
+    ----------
+    records: iterable
+        [abspath, ctime, fsize, fhash, ...] records to add
+    algorithm: str
+        algorithm of the digests, see HASHES
+    """
+
+    def __init__(self, records=(), algorithm=DEFAULT_HASH):
+        self.algorithm = algorithm
+        self.width = HASHES[algorithm]().digest_size
+        self.dirs = []
+        self.dir_ids = {}
+        self.dir_of = array('I')
+        self.names = []
+        self.ctime = array('d')
+        self.size = array('q')
+        # nan and 0 stand for the missing mtime and inode of older records
+        self.mtime = array('d')
+        self.inode = array('Q')
+        self.digests = bytearray()
+        self.hashed = bytearray()
+        self.extend(records)
+
+    @classmethod
+    def from_index(cls, index, algorithm=DEFAULT_HASH):
+        """
+        Load the records of a `phoso.index.HashIndex`, one row at a time
+        """
+        return cls(iter(index), algorithm)
+
+    def append(self, record):
+        dirname, fname = os.path.split(record[0])
+        # with a trailing separator, paths are built by concatenation
+        dirname = os.path.join(dirname, '')
+        dir_id = self.dir_ids.get(dirname)
+        if dir_id is None:
+            dir_id = self.dir_ids[dirname] = len(self.dirs)
+            self.dirs.append(dirname)
+        self.dir_of.append(dir_id)
+        self.names.append(fname)
+        self.ctime.append(record[1])
+        self.size.append(record[2])
+        mtime = record[4] if len(record) > 4 else None
+        inode = record[5] if len(record) > 5 else None
+        self.mtime.append(float('nan') if mtime is None else mtime)
+        self.inode.append(inode or 0)
+        fhash = record[3]
+        if fhash is not None and hash_algorithm(fhash) == self.algorithm:
+            self.digests += bytes.fromhex(fhash.rpartition(':')[2])
+            self.hashed.append(1)
+        else:
+            self.digests += bytes(self.width)
+            self.hashed.append(0)
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def __len__(self):
+        return len(self.names)
+
+    def path(self, i):
+        return self.dirs[self.dir_of[i]] + self.names[i]
+
+    def digest(self, i):
+        """
+        Binary digest of record i, None if it is not hashed
+        """
+        if not self.hashed[i]:
+            return None
+        return bytes(self.digests[i*self.width:(i+1)*self.width])
+
+    def hex(self, i):
+        """
+        Digest of record i as returned by `file_hash`, None if it is not hashed
+        """
+        if not self.hashed[i]:
+            return None
+        fhash = self.digests[i*self.width:(i+1)*self.width].hex()
+        return fhash if self.algorithm == DEFAULT_HASH else self.algorithm + ':' + fhash
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        mtime = self.mtime[i]
+        return [self.path(i), self.ctime[i], self.size[i], self.hex(i),
+                None if mtime != mtime else mtime, self.inode[i] or None]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def duplicate_groups(self):
+        """
+        Indices of the records sharing a digest, as lists in input order
+        """
+        data = bytes(self.digests)
+        width = self.width
+        by_digest = defaultdict(list)
+        for i, hashed in enumerate(self.hashed):
+            if hashed:
+                by_digest[data[i*width:(i+1)*width]].append(i)
+        return [group for group in by_digest.values() if len(group) > 1]
+
+    def take(self, indices):
+        """
+        New store with the records at indices, sharing the interned directories
+        """
+        other = HashRecords(algorithm=self.algorithm)
+        other.dirs = self.dirs
+        other.dir_ids = self.dir_ids
+        width = self.width
+        other.dir_of = array('I', (self.dir_of[i] for i in indices))
+        other.names = [self.names[i] for i in indices]
+        other.ctime = array('d', (self.ctime[i] for i in indices))
+        other.size = array('q', (self.size[i] for i in indices))
+        other.mtime = array('d', (self.mtime[i] for i in indices))
+        other.inode = array('Q', (self.inode[i] for i in indices))
+        data = bytes(self.digests)
+        other.digests = bytearray().join(data[i*width:(i+1)*width] for i in indices)
+        other.hashed = bytearray(self.hashed[i] for i in indices)
+        return other
+
+    def keep(self, indices):
+        """
+        Keep only the records at indices, in place
+        """
+        other = self.take(indices)
+        for column in ('dir_of', 'names', 'ctime', 'size', 'mtime', 'inode', 'digests', 'hashed'):
+            setattr(self, column, getattr(other, column))
+
+
+class DigestSet:
+    """
+    Set of the digests of one algorithm, stored as a sorted array of binary
+    digests searched by bisection: 20 bytes per sha1 digest instead of a str
+    object of 40 characters and a hash table slot.
+
+    Parameters
+    ----------
+    digests: iterable
+        digests as returned by `file_hash`, None and digests of other
+        algorithms are ignored
+    algorithm: str
+        algorithm of the digests, see HASHES
+    """
+
+    def __init__(self, digests, algorithm=DEFAULT_HASH):
+        self.algorithm = algorithm
+        self.width = HASHES[algorithm]().digest_size
+        if isinstance(digests, HashRecords) and digests.algorithm == algorithm:
+            keys = sorted({digests.digest(i) for i in range(len(digests)) if digests.hashed[i]})
+        else:
+            keys = sorted({self._key(d) for d in digests
+                           if d is not None and hash_algorithm(d) == algorithm})
+        self.data = b''.join(keys)
+
+    def _key(self, fhash):
+        return bytes.fromhex(fhash.rpartition(':')[2])
+
+    def __len__(self):
+        return len(self.data) // self.width
+
+    def __contains__(self, fhash):
+        """
+        fhash is a digest as returned by `file_hash`, or a binary digest
+        """
+        if isinstance(fhash, bytes):
+            key = fhash
+        elif fhash is None or hash_algorithm(fhash) != self.algorithm:
+            return False
+        else:
+            key = self._key(fhash)
+        width = self.width
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.data[mid*width:(mid+1)*width] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return self.data[lo*width:(lo+1)*width] == key
+
+
 def common_hashes(source_hashes, destination_hashes):
     """
+    Parameters
+    ----------
+    source_hashes: list or HashRecords
+    destination_hashes: list, HashRecords or DigestSet
+        hashes of the destination
+
     Returns
     -------
     source_hashes: list
@@ -115,15 +656,34 @@ def common_hashes(source_hashes, destination_hashes):
         list of hashes popped from source because they were already in destination
 
     """
-    destination_h = [x[3] for x in destination_hashes]
-    commons = []
-
-    n_source = len(source_hashes)
-    for i in range(n_source):
-        # go reverse
-        i_source = n_source - i - 1
-        if source_hashes[i_source][3] in destination_h:
-            commons.append(source_hashes.pop(i_source))
+    if isinstance(source_hashes, HashRecords):
+        # binary digests are compared
+        algorithm = source_hashes.algorithm
+        if isinstance(destination_hashes, DigestSet):
+            destination_d = destination_hashes
+        elif isinstance(destination_hashes, HashRecords):
+            destination_d = set()
+            if destination_hashes.algorithm == algorithm:
+                destination_d = {destination_hashes.digest(i) for i in range(len(destination_hashes))
+                                 if destination_hashes.hashed[i]}
+        else:
+            destination_d = {bytes.fromhex(x[3].rpartition(':')[2]) for x in destination_hashes
+                             if x[3] is not None and hash_algorithm(x[3]) == algorithm}
+        data = bytes(source_hashes.digests)
+        width = source_hashes.width
+        common = [hashed and data[i*width:(i+1)*width] in destination_d
+                  for i, hashed in enumerate(source_hashes.hashed)]
+        commons = [source_hashes[i] for i, c in enumerate(common) if c]
+        source_hashes.keep([i for i, c in enumerate(common) if not c])
+        return source_hashes, commons
+
+    if isinstance(destination_hashes, DigestSet):
+        destination_h = destination_hashes
+    else:
+        destination_h = {x[3] for x in destination_hashes if x[3] is not None}
+
+    commons = [x for x in source_hashes if x[3] in destination_h]
+    source_hashes[:] = [x for x in source_hashes if x[3] not in destination_h]
 
     return source_hashes, commons
 
@@ -131,35 +691,166 @@ def common_hashes(source_hashes, destination_hashes):
 
 
 
-def cull(root:str, hash_list_path: str, dry_run:bool=False):
+def cull(root:str, hash_list_path: str, dry_run:bool=False, keep:str='first', plan_file:str=None,
+         metrics=NULL_METRICS, jobs:int=1, algorithm:str=DEFAULT_HASH, resume:bool=False):
     '''
-    Given root directory and a file containing a list of all hashes
-    - recurse through the tree and create an updated list of file hashes
-    - sort by ctime
-    - tabulate all duplicates
-    - delete all duplicates
-    - write an updated hash_list
+    Given root directory and a hash index (or a JSON hash list, which is
+    imported into an index next to it the first time)
+    - recurse through the tree and add the new file hashes to the index
+    - tabulate all duplicates, keeping one copy of each group
+    - delete all duplicates still identical to the copy kept, see
+      `phoso.plan.transfer_file`
+    - remove the deleted files from the index
+
+    A killed run loses little work: hashes are committed to the index as
+    they are computed, and deletions are committed in batches. The pending
+    deletions are kept in a plan file next to the index until they are all
+    done, so that a resumed run finishes them without scanning root again.
 
     Args:
         root: directory with files
-        hash_list_path: path for hash list
+        hash_list_path: path for hash index, see `phoso.index.open_index`
+        dry_run: only report the duplicates, the index keeps their rows
+        keep: copy kept in each group of duplicates, 'first' (by path),
+            'oldest' (by ctime) or 'shortest' (by path length), see KEEPERS
+        plan_file: if not None, the deletions are written to this plan file
+            instead, to be executed later with `phoso.plan.apply_plan`. The
+            index keeps the duplicates until a later run prunes them.
+        metrics: `phoso.metrics.RunMetrics` collecting the time spent in each
+            stage (scan, edge_hash, hash, delete) and reporting progress
+        jobs: number of threads reading and hashing files
+        algorithm: digest used to compare files, see HASHES
+        resume: finish the deletions of an interrupted run, if any, instead
+            of looking for duplicates again
 
     '''
 
-    LOGGER.info('Hashing files')
-
-    hashpairs = read_hash(hash_list_path)
-    new_hashpairs = hash_tree(root, already_hashed=hashpairs)
-
-    hashpairs = sorted(hashpairs + new_hashpairs, key=lambda x: x[0])
-
-    hashpairs, duplicates = extract_duplicates(hashpairs)
+    with open_index(hash_list_path) as index:
+        pending = index.path + '.pending'
+        if resume and os.path.exists(pending):
+            actions = []
+            deleted = []
+            for action in read_plan(pending):
+                (actions if os.path.exists(action[1]) else deleted).append(action)
+            # deleted by the interrupted run after its last commit
+            index.delete([x[1] for x in deleted])
+            index.commit()
+            LOGGER.info('Resuming the %s remaining deletions of %s', len(actions), pending)
+        else:
+            LOGGER.info('Hashing files')
+            hash_tree(root, already_hashed=index, metrics=metrics, jobs=jobs, algorithm=algorithm)
+
+            actions = []
+            for group in index.duplicate_groups():
+                keeper, others = choose_keeper(group, keep)
+                actions += [('delete', x[0], keeper[0], 'duplicate') for x in others]
+
+        if plan_file is not None:
+            plan = PlanWriter(plan_file)
+            plan.write(actions)
+            plan.close()
+            return
+
+        if dry_run:
+            # the duplicates are still there, they stay in the index
+            for _, path, kept, _ in actions:
+                LOGGER.info('Would delete %s, a duplicate of %s', path, kept)
+            LOGGER.info('%s duplicates would be deleted', len(actions))
+            return
+
+        plan = PlanWriter(pending)
+        plan.write(actions)
+        plan.close()
+        for start in range(0, len(actions), DELETE_BATCH):
+            batch = actions[start:start+DELETE_BATCH]
+            with metrics.timer('delete'):
+                # checks again that the kept copy is there and identical,
+                # the pending deletions of a resumed run may be old
+                apply_actions(batch)
+            removed = [x[1] for x in batch if not os.path.lexists(x[1])]
+            metrics.add('delete', len(removed))
+            index.delete(removed)
+            index.commit()
+            metrics.progress(start + len(batch), len(actions))
+        os.remove(pending)
+
+
+def dedup_incoming(src_dir: str, hash_list_path: str, action: str = 'report', hold_dir: str = None,
+                   plan_file: str = None, metrics=NULL_METRICS, jobs: int = 1,
+                   algorithm: str = DEFAULT_HASH):
+    '''
+    Find the files of an incoming tree (e.g. a memory card) that are already
+    in an archive, and remove, hold or report them.
 
-    if not dry_run:
-        for hash_tuple in duplicates:
-            LOGGER.debug('Deleting duplicate file %s', hash_tuple[0])
-            os.remove(hash_tuple[0])
+    The archive is not scanned: only its hash index is read, for the sizes of
+    the incoming files. An incoming file whose size is not in the archive is
+    not read. The others are hashed together with the archive files of the
+    same size, as in `fill_hashes`, so archive files are only read when they
+    were never hashed and their edges match an incoming file. The hashes
+    computed for the archive are saved in its index.
 
-    write_hash(hashpairs, hash_list_path)
-    
-    
+    Args:
+        src_dir: incoming directory, searched recursively
+        hash_list_path: hash index of the archive, see `phoso.index.open_index`
+        action: 'report' only logs the archived files, 'delete' deletes them and
+            'hold' moves them to hold_dir, keeping their path relative to src_dir
+        hold_dir: holding directory for action 'hold'
+        plan_file: if not None, the actions are written to this plan file
+            instead of being executed, see `phoso.plan.apply_plan`
+        metrics: `phoso.metrics.RunMetrics`
+        jobs: number of threads reading and hashing files
+        algorithm: digest used to compare files, see HASHES
+
+    Returns the list of (action, incoming file, archived file, 'archived')
+    '''
+    if action == 'hold' and hold_dir is None:
+        raise ValueError('hold_dir is needed to hold files')
+    src_dir = os.path.abspath(src_dir)
+    prefix = os.path.join(src_dir, '')
+
+    incoming = []
+    with metrics.timer('scan'):
+        for entry in scan_tree(src_dir):
+            stat = entry.stat()
+            incoming.append([entry.path, stat.st_ctime, stat.st_size, None, stat.st_mtime, stat.st_ino])
+    metrics.add('scan', len(incoming))
+
+    with open_index(hash_list_path) as index:
+        archive = {}
+        for fsize in {x[2] for x in incoming}:
+            records = [x for x in index.with_size(fsize) if not x[0].startswith(prefix)]
+            if records:
+                archive[fsize] = records
+        candidates = [x for x in incoming if x[2] in archive]
+        related = [x for records in archive.values() for x in records]
+        LOGGER.info('%s incoming files, %s share their size with %s archived files',
+                    len(incoming), len(candidates), len(related))
+
+        unhashed = [x for x in related if x[3] is None or hash_algorithm(x[3]) != algorithm]
+        fill_hashes(related + candidates, verbose=False, metrics=metrics, jobs=jobs,
+                    algorithm=algorithm)
+        index.upsert([x for x in unhashed if x[3] is not None])
+
+        digests = DigestSet((x[3] for x in related), algorithm)
+        _, archived = common_hashes(candidates, digests)
+
+        actions = []
+        for record in archived:
+            match = next(x[0] for x in index.with_hash(record[3]) if not x[0].startswith(prefix))
+            if action == 'hold':
+                actions.append(('hold', record[0], os.path.join(hold_dir, os.path.relpath(record[0], src_dir)),
+                                'archived'))
+            elif action == 'delete':
+                actions.append(('delete', record[0], match, 'archived'))
+            else:
+                actions.append(('skip', record[0], match, 'archived'))
+            LOGGER.info('%s is archived as %s', record[0], match)
+    LOGGER.info('%s of %s incoming files are already archived', len(actions), len(incoming))
+
+    if plan_file is not None:
+        plan = PlanWriter(plan_file)
+        plan.write(actions)
+        plan.close()
+    elif action != 'report':
+        apply_actions(actions, metrics=metrics)
+    return actions
@@ -0,0 +1,167 @@
+"""
+dest.py
+
+In-memory views of the destination tree used by `phoso.sort.sortphotos` to
+resolve name collisions and find duplicates without probing the filesystem.
+"""
+
+import logging
+import os
+from collections import defaultdict
+
+from .cull import DEFAULT_HASH, file_hash, hash_algorithm, hash_tree
+from .index import open_index
+from .metrics import NULL_METRICS
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _listdir(dirpath):
+    try:
+        return set(os.listdir(dirpath))
+    except FileNotFoundError:
+        return None
+
+
+class NameTable:
+    """
+    Names of the files in each destination directory. A directory is listed
+    once, the first time it is looked at, and names claimed by the run are
+    added to the listing.
+
+    `existing` holds the directories known to exist, the listed ones and
+    those created by `phoso.plan.make_dirs`, so that each is created once.
+
+    The listings go stale when other processes write to the destination,
+    `clear` drops them, e.g. between the batches of a watch.
+    """
+
+    def __init__(self):
+        self.listings = {}
+        self.existing = set()
+
+    def _store(self, dirpath, listing):
+        if listing is None:
+            listing = set()
+        else:
+            self.existing.add(dirpath)
+        self.listings[dirpath] = listing
+        return listing
+
+    def names(self, dirpath):
+        listing = self.listings.get(dirpath)
+        if listing is None:
+            listing = self._store(dirpath, _listdir(dirpath))
+        return listing
+
+    def prefetch(self, dirpaths, executor):
+        """
+        List the directories that are not listed yet, in parallel
+        """
+        todo = [d for d in set(dirpaths) if d not in self.listings]
+        for dirpath, listing in zip(todo, executor.map(_listdir, todo)):
+            self._store(dirpath, listing)
+
+    def clear(self):
+        """
+        Forget the listings and directories, they are looked at again
+        """
+        self.listings.clear()
+        self.existing.clear()
+
+    def exists(self, path):
+        dirpath, fname = os.path.split(path)
+        return fname in self.names(dirpath)
+
+    def claim(self, path):
+        dirpath, fname = os.path.split(path)
+        self.names(dirpath).add(fname)
+
+
+class ContentIndex:
+    """
+    Content hashes of the files in dest_dir, kept in a `phoso.cull` hash index
+    so that a duplicate is found wherever it sits in dest_dir.
+
+    The index is brought up to date with an incremental `hash_tree` of
+    dest_dir. Like `hash_tree`, files are only hashed when another file has
+    the same size.
+    """
+
+    def __init__(self, dest_dir, index_path, metrics=NULL_METRICS):
+        self.index = open_index(index_path)
+        self.metrics = metrics
+        self.prefix = os.path.join(os.path.abspath(dest_dir), '')
+        hash_tree(dest_dir, verbose=False, already_hashed=self.index, metrics=metrics)
+        # files planned by the run but not transferred yet, by size
+        # [[dest_file, src_file, fhash]...]
+        self.pending = defaultdict(list)
+
+    def _candidates(self, fsize):
+        records = [x for x in self.index.with_size(fsize) if x[0].startswith(self.prefix)]
+        return records, self.pending.get(fsize, [])
+
+    def _hash(self, path, fsize):
+        with self.metrics.timer('hash'):
+            fhash = file_hash(path)
+        self.metrics.add('hash', 1, fsize)
+        return fhash
+
+    def find(self, src_file, fsize):
+        """
+        Look for a file of dest_dir identical to src_file
+
+        Returns
+        -------
+        match: str
+            path of the identical file, or None
+        src_hash: str
+            hash of src_file, None if no file of dest_dir has its size
+        """
+        records, pending = self._candidates(fsize)
+        if not records and not pending:
+            return None, None
+
+        src_hash = self._hash(src_file, fsize)
+        for record in records:
+            if record[3] is None or hash_algorithm(record[3]) != DEFAULT_HASH:
+                try:
+                    record[3] = self._hash(record[0], fsize)
+                except OSError:
+                    continue
+                self.index.upsert([record])
+            if record[3] == src_hash:
+                return record[0], src_hash
+        for entry in pending:
+            if entry[2] is None:
+                entry[2] = self._hash(entry[1], fsize)
+            if entry[2] == src_hash:
+                return entry[0], src_hash
+        return None, src_hash
+
+    def add(self, dest_file, src_file, fsize, fhash=None):
+        """
+        Register a file that will be transferred to dest_file
+        """
+        self.pending[fsize].append([dest_file, src_file, fhash])
+
+    def flush(self):
+        """
+        Record the transferred files in the index, once they are in place
+        """
+        records = []
+        for entries in self.pending.values():
+            for dest_file, src_file, fhash in entries:
+                try:
+                    stat = os.stat(dest_file)
+                except OSError:
+                    continue
+                records.append([os.path.abspath(dest_file), stat.st_ctime, stat.st_size,
+                                fhash, stat.st_mtime, stat.st_ino])
+        self.index.upsert(records)
+        self.index.commit()
+        self.pending.clear()
+
+    def close(self):
+        self.flush()
+        self.index.close()
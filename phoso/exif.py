@@ -0,0 +1,465 @@
+"""
+exif.py
+
+Batched EXIF extraction. Reads the date and camera model of many files with
+as few process spawns as possible:
+
+- the linux `exif` backend is replaced by an in-process parser of the EXIF
+  block of JPEG, TIFF and Panasonic RW2 files, and of the headers of video
+  containers: MP4/MOV/3GP (moov/mvhd and QuickTime keys) and AVCHD MTS (MDPM
+  metadata). Only the few kB holding the metadata are read, with seeks.
+- the `exiftool` backend is called once per batch of files with JSON output
+"""
+
+import json
+import logging
+import os
+import struct
+import subprocess
+from subprocess import PIPE
+from datetime import datetime, timedelta, timezone
+
+EXIF_DATE_FORMAT = '%Y:%m:%d %H:%M:%S'
+
+# TIFF tags of interest
+TAG_MODEL = 0x0110
+TAG_DATETIME = 0x0132
+TAG_EXIF_IFD = 0x8769
+TAG_DATETIME_ORIGINAL = 0x9003
+TAG_DATETIME_DIGITIZED = 0x9004
+# RW2 tag holding the offset and length of the embedded JPEG with the EXIF block
+TAG_JPG_FROM_RAW = 0x002e
+
+# date tags in order of preference, with the names used by each backend
+EXIF_DATE_TAGS = [TAG_DATETIME_ORIGINAL, TAG_DATETIME_DIGITIZED, TAG_DATETIME]
+EXIFTOOL_DATE_TAGS = ['DateTimeCreated', 'DateTimeOriginal', 'CreateDate']
+
+# how far into a JPEG to look for the EXIF APP1 segment, and how much of a
+# TIFF file to read for its IFDs
+_JPEG_MAX_HEADER = 1 << 20
+_TIFF_MAX_HEADER = 1 << 16
+
+_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8}
+
+# TIFF headers: standard little and big endian, and Panasonic RW2
+_TIFF_HEADERS = (b'II*\x00', b'MM\x00*', b'IIU\x00')
+
+# QuickTime and MP4 times are seconds since 1904-01-01 UTC
+_QT_EPOCH = datetime(1904, 1, 1, tzinfo=timezone.utc)
+# boxes that hold other boxes on the path to the metadata
+_CONTAINER_BOXES = {b'moov', b'udta', b'meta'}
+_VIDEO_TOP_BOXES = {b'ftyp', b'moov', b'mdat', b'wide', b'free', b'skip', b'pnot'}
+_QT_MAX_META = 1 << 16
+QT_KEY_DATE = 'com.apple.quicktime.creationdate'
+QT_KEY_MODEL = 'com.apple.quicktime.model'
+
+# AVCHD: MDPM metadata in the H.264 SEI of the first packets of the stream
+_MTS_MAX_HEADER = 1 << 18
+
+
+def _read_tiff_header(fobj, base=0):
+    """
+    Returns the bytes of the TIFF structure holding the EXIF data, or None if
+    the file is neither a JPEG with an EXIF APP1 segment nor a TIFF file.
+    base is the offset of the JPEG or TIFF data in the file.
+    """
+    fobj.seek(base)
+    head = fobj.read(4)
+    if head[:2] == b'\xff\xd8':
+        fobj.seek(base + 2)
+        while fobj.tell() < base + _JPEG_MAX_HEADER:
+            marker = fobj.read(2)
+            if len(marker) < 2 or marker[0] != 0xff:
+                return None
+            if marker[1] in (0xd9, 0xda):
+                # end of image or start of scan, no EXIF before image data
+                return None
+            if 0xd0 <= marker[1] <= 0xd7 or marker[1] == 0x01:
+                continue
+            seg_len = struct.unpack('>H', fobj.read(2))[0]
+            if marker[1] == 0xe1:
+                segment = fobj.read(seg_len - 2)
+                if segment[:6] == b'Exif\x00\x00':
+                    return segment[6:]
+            else:
+                fobj.seek(seg_len - 2, os.SEEK_CUR)
+        return None
+    if head in _TIFF_HEADERS:
+        fobj.seek(base)
+        return fobj.read(_TIFF_MAX_HEADER)
+    return None
+
+
+def _read_ifd(data, offset, endian, wanted):
+    """
+    Read the ascii and long values of the `wanted` tags from the IFD at offset
+    """
+    values = {}
+    if offset + 2 > len(data):
+        return values
+    n_entries = struct.unpack(endian + 'H', data[offset:offset+2])[0]
+    for i in range(n_entries):
+        entry = offset + 2 + 12*i
+        if entry + 12 > len(data):
+            break
+        tag, typ, count = struct.unpack(endian + 'HHI', data[entry:entry+8])
+        if tag not in wanted:
+            continue
+        size = _TYPE_SIZES.get(typ, 1) * count
+        if size <= 4:
+            raw = data[entry+8:entry+8+size]
+        else:
+            pointer = struct.unpack(endian + 'I', data[entry+8:entry+12])[0]
+            raw = data[pointer:pointer+size]
+        if typ == 2:
+            values[tag] = raw.split(b'\x00', 1)[0].decode('utf-8', 'replace').strip()
+        elif typ == 4 and len(raw) >= 4:
+            values[tag] = struct.unpack(endian + 'I', raw[:4])[0]
+        elif typ == 7 and size > 4:
+            # data that may be outside of `data`: (offset, length)
+            values[tag] = (struct.unpack(endian + 'I', data[entry+8:entry+12])[0], size)
+    return values
+
+
+def _read_exif(fobj, base=0):
+    data = _read_tiff_header(fobj, base)
+    if not data or len(data) < 8:
+        return None
+
+    endian = '<' if data[:2] == b'II' else '>'
+    ifd0 = struct.unpack(endian + 'I', data[4:8])[0]
+    tags = _read_ifd(data, ifd0, endian, {TAG_MODEL, TAG_DATETIME, TAG_EXIF_IFD, TAG_JPG_FROM_RAW})
+    exif_ifd = tags.pop(TAG_EXIF_IFD, None)
+    if exif_ifd:
+        tags.update(_read_ifd(data, exif_ifd, endian,
+                              {TAG_DATETIME_ORIGINAL, TAG_DATETIME_DIGITIZED}))
+    jpg_from_raw = tags.pop(TAG_JPG_FROM_RAW, None)
+    if jpg_from_raw and base == 0 and not any(t in tags for t in EXIF_DATE_TAGS):
+        # RW2 files keep their EXIF block in the embedded JPEG
+        embedded = _read_exif(fobj, jpg_from_raw[0])
+        if embedded:
+            embedded.update(tags)
+            tags = embedded
+    return tags
+
+
+def read_exif_tags(fname):
+    """
+    Parse the EXIF block of a JPEG, TIFF or RW2 file without any subprocess
+
+    Returns a dict {tag: value} with the date and model tags that were found,
+    or None if the file has no readable EXIF block
+    """
+    with open(fname, 'rb') as fobj:
+        return _read_exif(fobj)
+
+
+def _boxes(fobj, start, end):
+    """
+    Yields (type, offset of the payload, end) of the ISO BMFF boxes between
+    start and end, seeking over their payload
+    """
+    offset = start
+    while offset + 8 <= end:
+        fobj.seek(offset)
+        header = fobj.read(16)
+        if len(header) < 8:
+            return
+        size, kind = struct.unpack('>I4s', header[:8])
+        payload = offset + 8
+        if size == 1:
+            if len(header) < 16:
+                return
+            size = struct.unpack('>Q', header[8:16])[0]
+            payload += 8
+        elif size == 0:
+            size = end - offset
+        if size < payload - offset:
+            return
+        yield kind, payload, min(offset + size, end)
+        offset += size
+
+
+def _qt_datetime(seconds):
+    if not seconds:
+        return None
+    # UTC in the file, local time like the EXIF dates
+    try:
+        date = (_QT_EPOCH + timedelta(seconds=seconds)).astimezone()
+    except (OverflowError, ValueError, OSError):
+        # corrupt header, out of the range of datetime
+        return None
+    return date.replace(tzinfo=None)
+
+
+def _read_qt_keys(data):
+    """
+    Values of the QuickTime keys of a moov/meta box payload, {key: str}
+    """
+    keys = []
+    items = {}
+    # the ISO meta box starts with a version and flags, the QuickTime one does not
+    offset = 4 if data[:4] == b'\x00\x00\x00\x00' else 0
+    while offset + 8 <= len(data):
+        size, kind = struct.unpack('>I4s', data[offset:offset+8])
+        if size < 8:
+            break
+        body = data[offset+8:offset+size]
+        if kind == b'keys' and len(body) >= 8:
+            n_keys = struct.unpack('>I', body[4:8])[0]
+            pos = 8
+            for _ in range(n_keys):
+                if pos + 8 > len(body):
+                    break
+                key_size = struct.unpack('>I', body[pos:pos+4])[0]
+                keys.append(body[pos+8:pos+key_size].decode('utf-8', 'replace'))
+                pos += max(key_size, 8)
+        elif kind == b'ilst':
+            pos = 0
+            while pos + 8 <= len(body):
+                item_size, index = struct.unpack('>II', body[pos:pos+8])
+                if item_size < 8:
+                    break
+                item = body[pos+8:pos+item_size]
+                # data box: size, 'data', type, locale, value
+                if item[4:8] == b'data':
+                    items[index] = item[16:struct.unpack('>I', item[:4])[0]]
+                pos += item_size
+        offset += size
+    values = {}
+    for index, key in enumerate(keys, 1):
+        if index in items:
+            values[key] = items[index].decode('utf-8', 'replace').strip()
+    return values
+
+
+def _parse_iso_date(date_str):
+    """
+    Local time of an ISO 8601 date such as 2021-07-04T18:31:02+0200
+    """
+    try:
+        return datetime.strptime(date_str, '%Y-%m-%dT%H:%M:%S%z').replace(tzinfo=None)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(date_str).replace(tzinfo=None)
+    except ValueError:
+        return None
+
+
+def read_quicktime_tags(fname):
+    """
+    Creation date and model of an MP4, MOV or 3GP file, from the QuickTime
+    keys of moov/meta (local time, as written by phones) or else the creation
+    time of moov/mvhd. Only the box headers and these boxes are read: the
+    media data is skipped, wherever moov is in the file.
+
+    Returns a dict {tag: value} like `read_exif_tags`, or None if the file is
+    not an ISO BMFF file
+    """
+    with open(fname, 'rb') as fobj:
+        fobj.seek(0, os.SEEK_END)
+        fsize = fobj.tell()
+        fobj.seek(4)
+        if fobj.read(4) not in _VIDEO_TOP_BOXES:
+            return None
+
+        tags = {}
+        keys = {}
+        moov = next(((p, e) for kind, p, e in _boxes(fobj, 0, fsize) if kind == b'moov'), None)
+        if moov is None:
+            return tags
+        for kind, payload, end in _boxes(fobj, *moov):
+            if kind == b'mvhd':
+                fobj.seek(payload)
+                head = fobj.read(12)
+                if len(head) == 12:
+                    if head[0] == 1:
+                        seconds = struct.unpack('>Q', head[4:12])[0]
+                    else:
+                        seconds = struct.unpack('>I', head[4:8])[0]
+                    date = _qt_datetime(seconds)
+                    if date is not None:
+                        tags[TAG_DATETIME] = date.strftime(EXIF_DATE_FORMAT)
+            elif kind == b'meta' and end - payload <= _QT_MAX_META:
+                fobj.seek(payload)
+                keys = _read_qt_keys(fobj.read(end - payload))
+
+    date = _parse_iso_date(keys.get(QT_KEY_DATE, ''))
+    if date is not None:
+        tags[TAG_DATETIME_ORIGINAL] = date.strftime(EXIF_DATE_FORMAT)
+    if keys.get(QT_KEY_MODEL):
+        tags[TAG_MODEL] = keys[QT_KEY_MODEL]
+    return tags
+
+
+def _bcd(value):
+    return (value >> 4) * 10 + (value & 0x0f)
+
+
+def read_mts_tags(fname):
+    """
+    Recording date of an AVCHD MTS/M2TS file, from the MDPM metadata of the
+    H.264 stream, searched in the first packets of the file
+
+    Returns a dict {tag: value} like `read_exif_tags`, or None if the file is
+    not an MPEG transport stream
+    """
+    with open(fname, 'rb') as fobj:
+        data = fobj.read(_MTS_MAX_HEADER)
+    # 188 byte packets, or 192 with a timecode for M2TS
+    if not (data[0:1] == data[188:189] == b'\x47' or data[4:5] == data[196:197] == b'\x47'):
+        return None
+    tags = {}
+    pos = data.find(b'MDPM')
+    if pos < 0:
+        return tags
+    # remove the emulation prevention bytes of the H.264 stream
+    block = data[pos+4:pos+4+256].replace(b'\x00\x00\x03', b'\x00\x00')
+    n_entries = block[0] if block else 0
+    values = {}
+    for i in range(n_entries):
+        entry = block[1+5*i:6+5*i]
+        if len(entry) < 5:
+            break
+        values[entry[0]] = entry[1:]
+    # 0x18: time zone, year (2 bytes), month; 0x19: day, hours, minutes, seconds
+    if 0x18 in values and 0x19 in values:
+        raw = values[0x18][1:] + values[0x19]
+        if all((b >> 4) < 10 and (b & 0x0f) < 10 for b in raw):
+            digits = [_bcd(b) for b in raw]
+            tags[TAG_DATETIME_ORIGINAL] = '%02d%02d:%02d:%02d %02d:%02d:%02d' % tuple(digits)
+    return tags
+
+
+def read_media_tags(fname):
+    """
+    Date and model tags of a photo or a video, with the reader matching its
+    content: EXIF for JPEG, TIFF and RW2, else QuickTime or MTS headers
+
+    Returns a dict {tag: value}, or None if the file format is not supported
+    """
+    tags = read_exif_tags(fname)
+    if tags is None:
+        tags = read_quicktime_tags(fname)
+    if tags is None:
+        tags = read_mts_tags(fname)
+    return tags
+
+
+def file_mtime(src_file):
+    """
+    Modification time of a path, or of an os.DirEntry from its cached stat
+    """
+    if isinstance(src_file, os.DirEntry):
+        return src_file.stat().st_mtime
+    return os.path.getmtime(src_file)
+
+
+def _parse_date(candidates):
+    for date_str in candidates:
+        try:
+            return datetime.strptime(date_str, EXIF_DATE_FORMAT)
+        except (TypeError, ValueError):
+            pass
+    return None
+
+
+def _exif_batch(src_files):
+    """
+    In-process replacement for the linux `exif` command
+    """
+    results = {}
+    for src_file in src_files:
+        try:
+            tags = read_media_tags(src_file) or {}
+        except Exception as ex:
+            # any malformed header falls back to the modification time
+            logging.debug('{}: EXIF failed with error: {}'.format(src_file, ex))
+            tags = {}
+        date = _parse_date(tags.get(t) for t in EXIF_DATE_TAGS)
+        model = tags.get(TAG_MODEL) or None
+        results[src_file] = (date, model)
+    return results
+
+
+def _source_key(path):
+    return os.path.normcase(os.path.normpath(path))
+
+
+def _exiftool_batch(src_files, command):
+    """
+    Single exiftool call for a batch of files using its JSON output
+    """
+    args = [command, '-j', '-q', '-q']
+    args += ['-' + tag for tag in EXIFTOOL_DATE_TAGS + ['Model']]
+    args += ['--'] + list(src_files)
+    try:
+        sp = subprocess.run(args, stdout=PIPE, stderr=PIPE)
+    except OSError as ex:
+        # missing or misconfigured exiftool, the files fall back to their mtime
+        logging.error('{}: EXIF failed with error: {}'.format(command, ex))
+        return {src_file: (None, None) for src_file in src_files}
+    err_val = sp.stderr.decode().strip()
+    if err_val:
+        logging.debug('EXIF failed with error: {}'.format(err_val))
+    try:
+        records = json.loads(sp.stdout.decode() or '[]')
+    except ValueError:
+        records = []
+
+    # exiftool prints SourceFile with / on Windows
+    by_file = {_source_key(r['SourceFile']): r for r in records if 'SourceFile' in r}
+    results = {}
+    for src_file in src_files:
+        record = by_file.get(_source_key(src_file))
+        if record is None or 'Error' in record:
+            if record is not None:
+                logging.debug('{}: EXIF failed with error: {}'.format(src_file, record['Error']))
+            results[src_file] = (None, None)
+            continue
+        date = _parse_date(record.get(t) for t in EXIFTOOL_DATE_TAGS)
+        # exiftool prints an empty value rather than an error for a missing tag
+        model = str(record.get('Model', '')).strip()
+        results[src_file] = (date, model)
+    return results
+
+
+def exif_batch(src_files, exif_path, ignore_exif=False, batch_size=256):
+    """
+    Read the date and camera model of a batch of files
+
+    Args:
+        src_files: list of file paths or os.DirEntry
+        exif_path: path to the exif program. exiftool is called once per
+            `batch_size` files, any other value uses the in-process parser
+        ignore_exif: only use the file modification time
+        batch_size: maximum number of files per exiftool call
+
+    Returns:
+        dict {src_file: (date, model, date_fail)} with the same semantics as
+        `general_case_exif`, keyed by path
+    """
+    entries = list(src_files)
+    src_files = [os.fspath(x) for x in entries]
+    tags = {}
+    if not ignore_exif:
+        if 'exiftool' in exif_path:
+            for i in range(0, len(src_files), batch_size):
+                tags.update(_exiftool_batch(src_files[i:i+batch_size], exif_path))
+        else:
+            tags = _exif_batch(src_files)
+
+    results = {}
+    for src_file, entry in zip(src_files, entries):
+        if ignore_exif:
+            date = datetime.fromtimestamp(file_mtime(entry))
+            results[src_file] = (date, None, False)
+            continue
+        date, model = tags.get(src_file, (None, None))
+        date_fail = False
+        if date is None:
+            date = datetime.fromtimestamp(file_mtime(entry))
+            date_fail = True
+        results[src_file] = (date, model, date_fail)
+    return results
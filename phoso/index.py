@@ -0,0 +1,216 @@
+"""
+index.py
+
+Persistent hash index stored in SQLite. Replaces the JSON hash list of
+`phoso.cull` for large libraries: entries are keyed by path, indexed by hash
+and size, updated incrementally and committed in transactions so a killed run
+leaves the index in its last committed state.
+
+Paths are stored as the bytes of the file name (`os.fsencode`) in TEXT
+columns, so that names which are not valid UTF-8 on POSIX, decoded by Python
+with surrogate escapes, can be stored. `connect` decodes them back.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+from json.decoder import JSONDecodeError
+
+LOGGER = logging.getLogger(__name__)
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    ctime REAL,
+    size INTEGER,
+    hash TEXT,
+    mtime REAL,
+    inode INTEGER
+);
+CREATE INDEX IF NOT EXISTS files_hash ON files (hash);
+CREATE INDEX IF NOT EXISTS files_size ON files (size);
+'''
+
+
+def connect(path, **kwargs):
+    '''
+    SQLite connection whose text values are decoded as file names, the
+    inverse of `encode_path`
+    '''
+    conn = sqlite3.connect(path, **kwargs)
+    conn.text_factory = os.fsdecode
+    return conn
+
+
+def encode_path(path):
+    '''
+    Path as a query parameter, bound as CAST(? AS TEXT): SQLite stores the
+    bytes as they are, where a str with surrogates could not be encoded
+    '''
+    return os.fsencode(path)
+
+
+def path_range(base_dir):
+    '''
+    (low, high) bounds of the encoded paths inside base_dir, for a range query
+    '''
+    prefix = encode_path(os.path.join(os.path.abspath(base_dir), ''))
+    # every path starting with prefix sorts before prefix with its last byte incremented
+    return prefix, prefix[:-1] + bytes([prefix[-1] + 1])
+
+
+class HashIndex:
+    """
+    Hash list stored in an SQLite database
+
+    Records are [abspath, ctime, fsize, fhash, mtime, inode] lists, as in the
+    JSON hash list. mtime and inode are None for entries of older lists.
+    Changes are only persisted by `commit`, which is also called when the
+    index is used as a context manager and exits without error.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.conn = connect(self.path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(_SCHEMA)
+        # indexes created before mtime and inode were recorded
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(files)')]
+        for column, sqltype in [('mtime', 'REAL'), ('inode', 'INTEGER')]:
+            if column not in columns:
+                self.conn.execute('ALTER TABLE files ADD COLUMN {} {}'.format(column, sqltype))
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        self.close()
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def __contains__(self, path):
+        return self.get(path) is not None
+
+    def __iter__(self):
+        cursor = self.conn.execute('SELECT path, ctime, size, hash, mtime, inode FROM files ORDER BY path')
+        for row in cursor:
+            yield list(row)
+
+    def get(self, path):
+        row = self.conn.execute(
+            'SELECT path, ctime, size, hash, mtime, inode FROM files WHERE path = CAST(? AS TEXT)',
+            (encode_path(path),)).fetchone()
+        return None if row is None else list(row)
+
+    def has_hash(self, fhash):
+        return self.conn.execute(
+            'SELECT 1 FROM files WHERE hash = ? LIMIT 1', (fhash,)).fetchone() is not None
+
+    def with_hash(self, fhash):
+        return [list(row) for row in self.conn.execute(
+            'SELECT path, ctime, size, hash, mtime, inode FROM files WHERE hash = ? ORDER BY path', (fhash,))]
+
+    def with_size(self, fsize):
+        return [list(row) for row in self.conn.execute(
+            'SELECT path, ctime, size, hash, mtime, inode FROM files WHERE size = ?', (fsize,))]
+
+    def unhashed(self, base_dir):
+        """
+        Entries inside base_dir without a hash
+        """
+        return [list(row) for row in self.conn.execute(
+            'SELECT path, ctime, size, hash, mtime, inode FROM files '
+            'WHERE hash IS NULL AND path >= CAST(? AS TEXT) AND path < CAST(? AS TEXT)',
+            path_range(base_dir))]
+
+    def upsert(self, hash_pairs):
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO files (path, ctime, size, hash, mtime, inode) '
+            'VALUES (CAST(? AS TEXT), ?, ?, ?, ?, ?)',
+            ((encode_path(x[0]),) + tuple(x[1:6]) + (None,)*(6 - len(x)) for x in hash_pairs))
+
+    def delete(self, paths):
+        self.conn.executemany('DELETE FROM files WHERE path = CAST(? AS TEXT)',
+                              ((encode_path(p),) for p in paths))
+
+    def paths_under(self, base_dir):
+        """
+        Paths of the entries inside base_dir, found with a range query
+        """
+        cursor = self.conn.execute(
+            'SELECT path FROM files WHERE path >= CAST(? AS TEXT) AND path < CAST(? AS TEXT)',
+            path_range(base_dir))
+        return [row[0] for row in cursor]
+
+    def duplicate_groups(self):
+        """
+        Yields the lists of records sharing a hash, each sorted by path
+        """
+        cursor = self.conn.execute('''
+            SELECT path, ctime, size, hash, mtime, inode FROM files WHERE hash IN (
+                SELECT hash FROM files WHERE hash IS NOT NULL
+                GROUP BY hash HAVING COUNT(*) > 1)
+            ORDER BY hash, path''')
+        group = []
+        for row in cursor:
+            if group and group[0][3] != row[3]:
+                yield group
+                group = []
+            group.append(list(row))
+        if group:
+            yield group
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def import_json(json_path, index_path):
+    """
+    One-shot import of a JSON hash list into a HashIndex
+
+    Returns the number of imported records
+    """
+    LOGGER.info('Importing %s into %s', json_path, index_path)
+    try:
+        with open(os.path.expanduser(json_path), 'r') as f:
+            hashpairs = json.load(f)
+    except (FileNotFoundError, JSONDecodeError):
+        hashpairs = []
+
+    with HashIndex(index_path) as index:
+        index.upsert(hashpairs)
+    return len(hashpairs)
+
+
+def index_path(path):
+    """
+    Path of the SQLite index for path: a JSON hash list is mapped to an index
+    next to it (hashes.json -> hashes.sqlite)
+    """
+    path = os.path.expanduser(path)
+    root, ext = os.path.splitext(path)
+    if ext.lower() == '.json':
+        return root + '.sqlite'
+    return path
+
+
+def open_index(path):
+    """
+    Open the hash index at path. A path to a JSON hash list is mapped to an
+    index next to it (hashes.json -> hashes.sqlite), which is created from the
+    JSON list the first time.
+    """
+    path = os.path.expanduser(path)
+    db_path = index_path(path)
+    if db_path != path and not os.path.exists(db_path) and os.path.exists(path):
+        import_json(path, db_path)
+    return HashIndex(db_path)
@@ -0,0 +1,162 @@
+"""
+metrics.py
+
+Per-stage counters and timers for sort and cull runs (scan, cache, exif, hash,
+collision, mkdir, transfer), with a rate-limited progress line and optional
+JSON-lines events.
+
+Functions take a `metrics` argument that defaults to NULL_METRICS, whose
+methods do nothing, so instrumentation costs a method call when disabled.
+"""
+
+import json
+import logging
+import threading
+import time
+from contextlib import nullcontext
+from datetime import timedelta
+
+LOGGER = logging.getLogger(__name__)
+
+_NULL_TIMER = nullcontext()
+
+
+class NullMetrics:
+    '''
+    Metrics interface, and its disabled implementation
+    '''
+
+    def timer(self, stage):
+        '''context manager adding its duration to the time of stage'''
+        return _NULL_TIMER
+
+    def add(self, stage, files=1, nbytes=0):
+        '''count files and bytes processed by stage'''
+
+    def progress(self, done, total=None, nbytes=0):
+        '''report that done files out of total are processed'''
+
+    def event(self, kind, **fields):
+        '''record a structured event'''
+
+    def summary(self):
+        '''returns the totals, and records them'''
+        return {}
+
+
+NULL_METRICS = NullMetrics()
+
+
+class _Timer:
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics._add_time(self.stage, time.perf_counter() - self.start)
+
+
+class RunMetrics(NullMetrics):
+    '''
+    Collects per-stage times, file and byte counts
+
+    Args:
+        progress: stream for the progress line (e.g. sys.stdout), None for no progress
+        events: path of a JSON-lines file for the events and the summary, or None
+        interval: minimum number of seconds between two progress lines or progress events
+    '''
+
+    def __init__(self, progress=None, events=None, interval=0.5):
+        self.stream = progress
+        self.events = open(events, 'a') if events else None
+        self.interval = interval
+        self.start = time.perf_counter()
+        self.last_progress = 0.
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def _stage(self, stage):
+        return self.stages.setdefault(stage, {'seconds': 0., 'calls': 0, 'files': 0, 'bytes': 0})
+
+    def _add_time(self, stage, seconds):
+        with self.lock:
+            totals = self._stage(stage)
+            totals['seconds'] += seconds
+            totals['calls'] += 1
+
+    def timer(self, stage):
+        return _Timer(self, stage)
+
+    def add(self, stage, files=1, nbytes=0):
+        with self.lock:
+            totals = self._stage(stage)
+            totals['files'] += files
+            totals['bytes'] += nbytes
+
+    def progress(self, done, total=None, nbytes=0):
+        now = time.perf_counter()
+        final = total is not None and done >= total
+        if not final and now - self.last_progress < self.interval:
+            return
+        self.last_progress = now
+
+        elapsed = now - self.start
+        rate = done / elapsed if elapsed else 0.
+        fields = {'done': done, 'total': total, 'files_per_s': rate,
+                  'mb_per_s': nbytes / 1e6 / elapsed if elapsed else 0.}
+        if total is not None and rate:
+            fields['eta'] = (total - done) / rate
+        self.event('progress', **fields)
+
+        if self.stream is None:
+            return
+        if total:
+            numdots = int(20.0*done/total)
+            line = '[%-20s] %d of %d' % ('='*numdots, done, total)
+        else:
+            line = '%d files' % done
+        line += '  %.1f files/s' % rate
+        if nbytes:
+            line += '  %.1f MB/s' % fields['mb_per_s']
+        if 'eta' in fields:
+            line += '  ETA %s' % timedelta(seconds=int(fields['eta']))
+        self.stream.write('\r' + line + ' ')
+        if final:
+            self.stream.write('\n')
+        self.stream.flush()
+
+    def event(self, kind, **fields):
+        if self.events is None:
+            return
+        record = {'event': kind, 'time': time.perf_counter() - self.start}
+        record.update(fields)
+        with self.lock:
+            self.events.write(json.dumps(record) + '\n')
+
+    def summary(self):
+        '''
+        Totals per stage, with throughput. Logged, and written as a 'summary'
+        event, then the events file is closed.
+        '''
+        elapsed = time.perf_counter() - self.start
+        stages = {}
+        for stage, totals in self.stages.items():
+            totals = dict(totals)
+            if totals['seconds']:
+                totals['files_per_s'] = totals['files'] / totals['seconds']
+                totals['mb_per_s'] = totals['bytes'] / 1e6 / totals['seconds']
+            stages[stage] = totals
+            LOGGER.info('%s: %.3f s, %s files, %.1f MB', stage, totals['seconds'],
+                        totals['files'], totals['bytes'] / 1e6)
+        LOGGER.info('total: %.3f s', elapsed)
+
+        self.event('summary', seconds=elapsed, stages=stages)
+        if self.events is not None:
+            self.events.close()
+            self.events = None
+        return {'seconds': elapsed, 'stages': stages}
@@ -0,0 +1,319 @@
+"""
+plan.py
+
+Actions decided by `phoso.sort.sortphotos` and `phoso.cull.cull`, and their
+execution. An action is a tuple (action, src, dest, reason) where action is
+one of:
+
+- 'move': move src to dest
+- 'copy', 'reflink', 'hardlink': copy src to dest with this transfer method
+- 'hold': move src to dest in the holding directory
+- 'delete': delete src, dest is the copy that is kept. When it is on another
+  host, the reason is 'remote-duplicate:<hash>', the hash of src when planned
+- 'skip': nothing to do, recorded for the report
+
+A plan file stores the actions as JSON lines, so that planning (metadata and
+hashing only) and applying (file I/O only) can run separately. A journal
+uses the same format to record the actions completed by a run, so that an
+interrupted run can be resumed.
+"""
+
+import filecmp
+import json
+import logging
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from itertools import repeat
+
+from .metrics import NULL_METRICS
+from .transfer import temp_name, transfer
+
+LOGGER = logging.getLogger(__name__)
+
+TRANSFER_ACTIONS = ('move', 'copy', 'reflink', 'hardlink', 'hold')
+
+# reason of the deletions whose kept copy is on another host, followed by the hash
+REMOTE_DUPLICATE = 'remote-duplicate:'
+
+
+def _same_content(path_a, path_b):
+    try:
+        return os.path.getsize(path_a) == os.path.getsize(path_b) and \
+            filecmp.cmp(path_a, path_b, shallow=False)
+    except OSError:
+        return False
+
+
+def _has_hash(path, fhash):
+    # plan is imported by cull
+    from .cull import file_hash, hash_algorithm
+    try:
+        return file_hash(path, algorithm=hash_algorithm(fhash)) == fhash
+    except OSError:
+        return False
+
+
+def _transfer_free_name(method, src_file, dest_file):
+    '''
+    Transfer to dest_file, or to dest_file with a _N suffix if it exists.
+    Returns the destination, None if an identical file is already there
+    '''
+    root, ext = os.path.splitext(dest_file)
+    new_file = dest_file
+    append = 1
+    while True:
+        try:
+            transfer(src_file, new_file, method)
+            break
+        except FileExistsError:
+            if _same_content(src_file, new_file):
+                # done before, e.g. by an interrupted run
+                LOGGER.info('%s is already in %s', src_file, new_file)
+                if method == 'rename':
+                    os.remove(src_file)
+                return None
+            new_file = '{}_{}{}'.format(root, append, ext)
+            append += 1
+    if new_file != dest_file:
+        LOGGER.warning('%s exists, %s was written to %s instead', dest_file, src_file, new_file)
+    return new_file
+
+
+def transfer_file(action, src_file, dest_file, reason=None):
+    '''
+    Execute a single action, the directory of dest_file must exist
+
+    Actions are checked again when they run, since the files may have
+    changed since they were planned. An existing dest_file is never
+    replaced: the file goes to the first free name with a _N suffix, or
+    nowhere when dest_file has the same content. A deletion is skipped when
+    the copy kept (dest_file) is gone or differs from src_file, or, for
+    near-duplicates (reason 'similar'), only when it is gone. A duplicate of
+    a file of another host is only deleted if its hash did not change.
+
+    Args:
+        action: one of 'move', 'copy', 'reflink', 'hardlink', 'hold', 'delete' or 'skip'
+        src_file: source file
+        dest_file: destination file, or the holding file for 'hold', or the
+            kept copy for 'delete'
+        reason: reason of the action
+
+    Returns the path written, None if nothing was transferred
+    '''
+    if action in ('move', 'hold'):
+        return _transfer_free_name('rename', src_file, dest_file)
+    elif action in ('copy', 'reflink', 'hardlink'):
+        return _transfer_free_name(action, src_file, dest_file)
+    elif action == 'delete':
+        if reason == 'similar':
+            kept = os.path.exists(dest_file)
+        elif reason is not None and reason.startswith(REMOTE_DUPLICATE):
+            # the kept copy cannot be checked from here, src must be unchanged
+            if not _has_hash(src_file, reason[len(REMOTE_DUPLICATE):]):
+                LOGGER.warning('Not deleting %s: it changed since it was hashed', src_file)
+                return None
+            kept = True
+        else:
+            kept = _same_content(src_file, dest_file)
+        if not kept:
+            LOGGER.warning('Not deleting %s: the copy kept, %s, is gone or differs', src_file, dest_file)
+            return None
+        os.remove(src_file)
+    return None
+
+
+def _make_dir(new_dir, created):
+    if os.path.dirname(new_dir) in created:
+        # a single mkdir instead of checking every parent
+        try:
+            os.mkdir(new_dir)
+        except FileExistsError:
+            pass
+    else:
+        os.makedirs(new_dir, exist_ok=True)
+        created.add(os.path.dirname(new_dir))
+    created.add(new_dir)
+
+
+def make_dirs(actions, created=None, executor=None):
+    '''
+    Create the destination directories of the actions, once each
+
+    Args:
+        actions: list of actions
+        created: set of the directories known to exist. They are not created
+            again, and the created directories are added to it, so that
+            directories shared by several batches are created once
+        executor: if not None, directories are created in parallel
+    '''
+    if created is None:
+        created = set()
+    dirs = sorted({os.path.dirname(a[2]) for a in actions if a[0] in TRANSFER_ACTIONS} - created)
+    if executor is None:
+        for new_dir in dirs:
+            _make_dir(new_dir, created)
+    else:
+        list(executor.map(_make_dir, dirs, repeat(created)))
+
+
+def _run_group(actions, done=None):
+    for action in actions:
+        transfer_file(*action)
+        if done is not None:
+            done(action)
+
+
+def apply_actions(actions, executor=None, metrics=NULL_METRICS, created=None, done=None):
+    '''
+    Execute a list of actions in order. With an executor, actions with
+    different destination directories run in parallel, actions within a
+    directory keep their order. created is the set of directories known to
+    exist, see `make_dirs`. done, if not None, is called with each action
+    once it is executed, e.g. `Journal.add`.
+    '''
+    with metrics.timer('mkdir'):
+        make_dirs(actions, created, executor)
+
+    with metrics.timer('transfer'):
+        if executor is None:
+            _run_group(actions, done)
+        else:
+            groups = OrderedDict()
+            for action in actions:
+                groups.setdefault(os.path.dirname(action[2] or action[1]), []).append(action)
+            list(executor.map(_run_group, groups.values(), repeat(done)))
+    metrics.add('transfer', sum(1 for a in actions if a[0] != 'skip'))
+
+
+def _action_line(action):
+    action, src, dest, reason = action
+    return json.dumps({'action': action, 'src': src, 'dest': dest, 'reason': reason}) + '\n'
+
+
+class PlanWriter:
+    '''
+    Writes actions to a plan file as JSON lines. The file is written under a
+    temporary name and only appears under its name on `close`, so that an
+    interrupted run does not leave a partial plan to be applied.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.fobj = open(temp_name(path), 'w')
+
+    def write(self, actions):
+        for action in actions:
+            self.fobj.write(_action_line(action))
+
+    def close(self):
+        self.fobj.close()
+        os.replace(self.fobj.name, self.path)
+
+
+class Journal:
+    '''
+    Append-only record of the actions completed by a run, so that an
+    interrupted run can be resumed without doing them again. Each action is
+    written as soon as it completes, and the journal is synced to disk after
+    each batch.
+
+    When resuming, the journal is first rewritten without the line a crash
+    may have cut, under a temporary name then renamed.
+
+    Args:
+        path: journal file
+        resume: keep the actions recorded by an earlier run, otherwise the
+            journal starts empty
+    '''
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        actions = list(read_plan(path)) if resume and os.path.exists(path) else []
+        with open(temp_name(path), 'w') as fobj:
+            fobj.writelines(_action_line(a) for a in actions)
+        os.replace(fobj.name, path)
+        # sources of the completed actions
+        self.done = {a[1] for a in actions}
+        self.fobj = open(path, 'a')
+        # actions complete in the threads of `apply_actions`
+        self.lock = threading.Lock()
+
+    def add(self, action):
+        '''
+        Record a completed action. It survives a crash of the process at
+        once, and a crash of the system after `sync`
+        '''
+        with self.lock:
+            self.fobj.write(_action_line(action))
+            self.fobj.flush()
+            self.done.add(action[1])
+
+    def sync(self):
+        with self.lock:
+            os.fsync(self.fobj.fileno())
+
+    def record(self, actions):
+        for action in actions:
+            self.add(action)
+        self.sync()
+
+    def close(self, finished=True):
+        '''
+        Close the journal, and delete it when the run is finished
+        '''
+        self.fobj.close()
+        if finished:
+            os.remove(self.path)
+
+
+def shard_of(action, n_shards):
+    '''
+    Shard of an action, all the actions of a destination directory share a shard
+    '''
+    key = os.path.dirname(action[2] or action[1])
+    return zlib.crc32(key.encode('utf-8', 'surrogateescape')) % n_shards
+
+
+def read_plan(path, shard=0, n_shards=1):
+    '''
+    Yields the actions of a plan file, optionally only those of one shard
+    '''
+    with open(path, 'r') as fobj:
+        for line in fobj:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # line of a journal cut by a crash
+                LOGGER.warning('Ignoring invalid line of %s: %r', path, line)
+                continue
+            action = (record['action'], record['src'], record['dest'], record.get('reason'))
+            if n_shards == 1 or shard_of(action, n_shards) == shard:
+                yield action
+
+
+def apply_plan(path, executor=None, shard=0, n_shards=1, batch_size=4096, metrics=NULL_METRICS):
+    '''
+    Execute the actions of a plan file, in batches of batch_size actions
+
+    Returns the number of executed actions
+    '''
+    count = 0
+    batch = []
+    created = set()
+    for action in read_plan(path, shard, n_shards):
+        if action[0] == 'skip':
+            continue
+        batch.append(action)
+        if len(batch) >= batch_size:
+            apply_actions(batch, executor, metrics, created)
+            count += len(batch)
+            metrics.progress(count)
+            batch = []
+    apply_actions(batch, executor, metrics, created)
+    count += len(batch)
+    LOGGER.info('Applied %s actions from %s', count, path)
+    return count
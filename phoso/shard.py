@@ -0,0 +1,181 @@
+"""
+shard.py
+
+Duplicates of an archive spread over several hosts, e.g. NAS heads.
+
+Each host hashes its own trees into a shard: a hash index of its files
+(`phoso.index.HashIndex`) tagged with the name of the host. Shards are built
+independently, so every file of a shard is hashed, since its duplicate may
+sit in another shard.
+
+The shards are then merged on any machine holding a copy of them: each shard
+is read in digest order by an SQLite cursor, and the cursors are combined
+with a k-way merge, so duplicates across shards are found in one sequential
+pass, holding one group of duplicates in memory at a time. The deletions are
+written to one plan file per host, to be applied there with
+`phoso.cmd.apply`.
+
+Shards can be tried on one machine by building one for each subdirectory of
+a tree.
+"""
+
+import heapq
+import logging
+import os
+import socket
+from itertools import groupby
+
+from .cull import DEFAULT_HASH, choose_keeper, hash_algorithm, hash_tree
+from .index import index_path, open_index
+from .metrics import NULL_METRICS
+from .plan import REMOTE_DUPLICATE, PlanWriter
+
+LOGGER = logging.getLogger(__name__)
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS shard (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+
+def _shard_info(index):
+    index.conn.executescript(_SCHEMA)
+    return dict(index.conn.execute('SELECT key, value FROM shard'))
+
+
+def hash_shard(root, shard_path, name=None, metrics=NULL_METRICS, jobs=1, algorithm=DEFAULT_HASH):
+    '''
+    Hash every file of root into the shard index shard_path
+
+    The run is incremental as `phoso.cull.hash_tree`, a shard can hold
+    several trees of a host by hashing them in turn.
+
+    Args:
+        root: directory, searched recursively
+        shard_path: shard index, see `phoso.index.open_index`
+        name: name of the shard, the plan file of its deletions is named
+            after it. Defaults to the name of an existing shard, or the host name
+        metrics: `phoso.metrics.RunMetrics`
+        jobs: number of threads reading and hashing files
+        algorithm: digest of the files, shards are only merged with shards of
+            the same digest, see `phoso.cull.HASHES`
+
+    Returns the name of the shard
+    '''
+    with open_index(shard_path) as index:
+        info = _shard_info(index)
+        if info.get('algorithm', algorithm) != algorithm:
+            raise ValueError('shard {} is hashed with {}, not {}'.format(
+                shard_path, info['algorithm'], algorithm))
+        name = name or info.get('name') or socket.gethostname()
+        roots = set(filter(None, info.get('roots', '').split('\n')))
+        roots.add(os.path.abspath(root))
+        index.conn.executemany('INSERT OR REPLACE INTO shard VALUES (?, ?)',
+                               [('name', name), ('algorithm', algorithm),
+                                ('roots', '\n'.join(sorted(roots)))])
+
+        LOGGER.info('Hashing %s into shard %s', root, name)
+        hash_tree(root, verbose=False, already_hashed=index, metrics=metrics, jobs=jobs,
+                  algorithm=algorithm, hash_all=True)
+    return name
+
+
+def _by_digest(shard_idx, conn, batch_size=4096):
+    '''
+    Yields (hash, shard_idx, path, ctime, size, mtime, inode) of the hashed
+    files of a shard, in (hash, path) order
+    '''
+    cursor = conn.execute('SELECT hash, path, ctime, size, mtime, inode FROM files '
+                          'WHERE hash IS NOT NULL ORDER BY hash, path')
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        for fhash, path, ctime, size, mtime, inode in rows:
+            yield fhash, shard_idx, path, ctime, size, mtime, inode
+
+
+def merge_shards(shard_paths, plan_dir, keep='first', metrics=NULL_METRICS):
+    '''
+    Find the duplicates across shards, and write the deletions of each shard
+    to <plan_dir>/<shard name>.plan
+
+    The copy kept in a group of duplicates is chosen among all the shards
+    with `phoso.cull.choose_keeper`, 'first' keeps the copy of the first
+    shard given. The dest of a deletion is the kept copy. When it is on
+    another host it cannot be checked when the plan is applied: the reason
+    is then 'remote-duplicate:<hash>' and the file is only deleted if it
+    still has this hash, see `phoso.plan.transfer_file`. Shards with the
+    same name share a plan file.
+
+    Args:
+        shard_paths: shard indexes, see `hash_shard`
+        plan_dir: directory of the plan files, created if needed
+        keep: copy kept in each group of duplicates, see `phoso.cull.KEEPERS`
+        metrics: `phoso.metrics.RunMetrics`, stage 'merge'
+
+    Raises ValueError if a shard does not exist or was not built by
+    `hash_shard`
+
+    Returns a dict {shard name: number of deletions}
+    '''
+    for path in shard_paths:
+        # open_index would create an empty index, and the host would be left out
+        if not os.path.exists(index_path(os.path.expanduser(path))):
+            raise ValueError('shard {} does not exist'.format(path))
+    indexes = [open_index(path) for path in shard_paths]
+    try:
+        for index, path in zip(indexes, shard_paths):
+            if index.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                                  "AND name = 'shard'").fetchone() is None:
+                raise ValueError('{} is not a shard, see hash_shard'.format(path))
+        infos = [_shard_info(index) for index in indexes]
+        algorithms = {info.get('algorithm', DEFAULT_HASH) for info in infos}
+        if len(algorithms) > 1:
+            raise ValueError('shards are hashed with different digests: {}'.format(
+                ', '.join(sorted(algorithms))))
+        algorithm = algorithms.pop()
+        names = [info.get('name') or os.path.splitext(os.path.basename(path))[0]
+                 for info, path in zip(infos, shard_paths)]
+
+        os.makedirs(plan_dir, exist_ok=True)
+        plans = {name: PlanWriter(os.path.join(plan_dir, name + '.plan')) for name in names}
+        counts = dict.fromkeys(plans, 0)
+        n_records = 0
+        n_groups = 0
+        freed = 0
+
+        merged = heapq.merge(*(_by_digest(i, index.conn) for i, index in enumerate(indexes)))
+        with metrics.timer('merge'):
+            for fhash, rows in groupby(merged, key=lambda row: row[0]):
+                group = list(rows)
+                n_records += len(group)
+                metrics.progress(n_records)
+                if len(group) < 2 or hash_algorithm(fhash) != algorithm:
+                    continue
+                n_groups += 1
+                # records as in hash lists, with the shard of each
+                records = [[path, ctime, size, fhash, mtime, inode, shard_idx]
+                           for fhash, shard_idx, path, ctime, size, mtime, inode in group]
+                keeper, others = choose_keeper(records, keep)
+                for record in others:
+                    name = names[record[6]]
+                    reason = 'duplicate' if name == names[keeper[6]] else REMOTE_DUPLICATE + fhash
+                    plans[name].write([('delete', record[0], keeper[0], reason)])
+                    counts[name] += 1
+                    freed += record[2]
+        metrics.add('merge', n_records)
+
+        for plan in plans.values():
+            plan.close()
+    finally:
+        for index in indexes:
+            index.close()
+
+    LOGGER.info('%s files in %s shards, %s groups of duplicates, %s deletions freeing %.1f MB',
+                n_records, len(indexes), n_groups, sum(counts.values()), freed / 1e6)
+    for name, count in counts.items():
+        LOGGER.info('%s: %s deletions', name, count)
+    return counts
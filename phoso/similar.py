@@ -0,0 +1,303 @@
+"""
+similar.py
+
+Near-duplicate images: the same photo re-saved, resized or re-encoded.
+
+Each image gets a 64 bit difference hash (dHash) of a 9x8 grayscale
+thumbnail, one bit per pair of horizontally adjacent pixels. Re-encoding or
+resizing an image flips few of these bits, so near-duplicates are images whose
+hashes are within a small Hamming distance. They are found with multi-index
+hashing instead of comparing all pairs: the hashes are split in blocks, and
+only hashes with a block within distance // blocks bits are compared.
+Matches are grouped in clusters with a suggested keeper: the image with the
+most pixels, then the largest file.
+
+Fingerprints are kept in a table of the hash index database, keyed by path
+and validated with size and mtime, so only new or modified images are decoded
+again.
+
+Decoding needs Pillow, which is optional: the rest of phoso does not use it.
+"""
+
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import combinations
+from math import comb
+
+from .index import connect, encode_path, index_path
+from .metrics import NULL_METRICS
+from .plan import PlanWriter
+from .utils import scan_tree
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+LOGGER = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ['jpg', 'jpeg', 'png', 'tif', 'tiff', 'bmp', 'gif', 'webp']
+HASH_SIZE = 8
+MAX_DISTANCE = 4
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS fingerprints (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    dhash TEXT,
+    pixels INTEGER
+);
+'''
+
+
+def dhash(path, hash_size=HASH_SIZE):
+    '''
+    Difference hash of an image
+
+    Returns (dhash, pixels): the hash as an int of hash_size**2 bits, and the
+    number of pixels of the image
+    '''
+    if Image is None:
+        raise ImportError('near-duplicate detection needs Pillow (pip install Pillow)')
+    with Image.open(path) as img:
+        pixels = img.width * img.height
+        # JPEG are decoded directly at a reduced scale
+        img.draft('L', (hash_size * 8, hash_size * 8))
+        img = ImageOps.exif_transpose(img)
+        small = img.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR)
+        data = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (data[offset + col] > data[offset + col + 1])
+    return value, pixels
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+def _n_blocks(bits, max_distance, n_hashes):
+    '''
+    Number of blocks with the fewest expected table lookups and comparisons
+    for n_hashes random hashes
+    '''
+    def cost(n_blocks):
+        width = bits // n_blocks
+        probes = sum(comb(width, r) for r in range(max_distance // n_blocks + 1))
+        return n_blocks * probes * (1 + 2 * n_hashes / 2 ** width)
+    return min(range(1, min(max_distance + 1, bits) + 1), key=cost)
+
+
+def _blocks(bits, n_blocks, radius):
+    '''
+    (shift, mask, flips) of n_blocks blocks of nearly equal width covering
+    bits bits, flips being the masks of the values of a block within radius
+    '''
+    blocks = []
+    start = 0
+    for idx in range(n_blocks):
+        width = (bits - start) // (n_blocks - idx)
+        flips = [sum(1 << bit for bit in flipped)
+                 for r in range(radius + 1) for flipped in combinations(range(width), r)]
+        blocks.append((start, (1 << width) - 1, flips))
+        start += width
+    return blocks
+
+
+class FingerprintIndex:
+    '''
+    Fingerprints of images, stored in a table of the hash index database
+
+    Records are [path, size, mtime, dhash, pixels] lists
+    '''
+
+    def __init__(self, path):
+        self.conn = connect(index_path(path))
+        self.conn.executescript(_SCHEMA)
+
+    def get(self, path, stat):
+        row = self.conn.execute('SELECT size, mtime, dhash, pixels FROM fingerprints '
+                                'WHERE path = CAST(? AS TEXT)', (encode_path(path),)).fetchone()
+        if row is None or (row[0], row[1]) != (stat.st_size, stat.st_mtime):
+            return None
+        return [path, row[0], row[1], int(row[2], 16), row[3]]
+
+    def upsert(self, records):
+        self.conn.executemany('INSERT OR REPLACE INTO fingerprints VALUES (CAST(? AS TEXT), ?, ?, ?, ?)',
+                              ([encode_path(r[0]), r[1], r[2], '%x' % r[3], r[4]] for r in records))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def _fingerprint(entry):
+    try:
+        stat = entry.stat()
+        fhash, pixels = dhash(entry.path)
+    except ImportError:
+        raise
+    except Exception as ex:
+        # not an image Pillow can read, or a truncated one
+        LOGGER.warning('Could not fingerprint %s: %s', entry.path, ex)
+        return None
+    return [entry.path, stat.st_size, stat.st_mtime, fhash, pixels]
+
+
+def fingerprint_tree(base_dir, index=None, jobs=1, metrics=NULL_METRICS):
+    '''
+    Fingerprints of the images of base_dir
+
+    Args:
+        base_dir: directory, searched recursively
+        index: `FingerprintIndex` of the fingerprints computed by earlier runs,
+            updated with the new ones, or None
+        jobs: number of threads decoding images
+        metrics: `phoso.metrics.RunMetrics`, stages 'scan' and 'fingerprint'
+
+    Returns a list of [path, size, mtime, dhash, pixels]
+    '''
+    with metrics.timer('scan'):
+        entries = list(scan_tree(os.path.abspath(base_dir), IMAGE_EXTENSIONS))
+    metrics.add('scan', len(entries))
+
+    records = []
+    todo = []
+    for entry in entries:
+        record = index.get(entry.path, entry.stat()) if index is not None else None
+        if record is None:
+            todo.append(entry)
+        else:
+            records.append(record)
+    LOGGER.info('Fingerprinting %s images, %s already done', len(todo), len(records))
+
+    new = []
+    with metrics.timer('fingerprint'):
+        if jobs > 1:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                results = executor.map(_fingerprint, todo, chunksize=64)
+                for idx, record in enumerate(results, 1):
+                    new.append(record)
+                    metrics.progress(idx, len(todo))
+        else:
+            for idx, entry in enumerate(todo, 1):
+                new.append(_fingerprint(entry))
+                metrics.progress(idx, len(todo))
+    new = [r for r in new if r is not None]
+    metrics.add('fingerprint', len(new), sum(r[1] for r in new))
+
+    if index is not None:
+        index.upsert(new)
+    return records + new
+
+
+def similar_groups(records, max_distance=MAX_DISTANCE):
+    '''
+    Clusters of near-duplicate images
+
+    Two images whose hashes are within max_distance are in the same cluster,
+    so clusters are the connected components of this relation.
+
+    Args:
+        records: list of [path, size, mtime, dhash, pixels]
+
+    Returns a list of clusters of 2 or more records, each sorted by path
+    '''
+    # records with the same hash are one node
+    by_hash = {}
+    for record in records:
+        by_hash.setdefault(record[3], []).append(record)
+    hashes = list(by_hash)
+    parent = list(range(len(hashes)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    # multi-index hashing: hashes within max_distance split in n_blocks
+    # blocks are within max_distance // n_blocks in at least one block, e.g.
+    # equal in one of max_distance + 1 blocks. Only the hashes found in the
+    # table of a block, within this radius, are compared. Many hashes call
+    # for fewer, wider blocks, whose buckets stay small.
+    bits = max([HASH_SIZE * HASH_SIZE] + [h.bit_length() for h in hashes])
+    n_blocks = _n_blocks(bits, max_distance, len(hashes))
+    blocks = _blocks(bits, n_blocks, max_distance // n_blocks)
+    tables = [{} for _ in blocks]
+    for i, value in enumerate(hashes):
+        compared = set()
+        for (shift, mask, flips), table in zip(blocks, tables):
+            block = (value >> shift) & mask
+            for flip in flips:
+                for j in table.get(block ^ flip, ()):
+                    if j not in compared:
+                        compared.add(j)
+                        if hamming(value, hashes[j]) <= max_distance:
+                            parent[find(i)] = find(j)
+            table.setdefault(block, []).append(i)
+
+    clusters = {}
+    for i, value in enumerate(hashes):
+        clusters.setdefault(find(i), []).extend(by_hash[value])
+    return [sorted(c) for c in clusters.values() if len(c) > 1]
+
+
+def choose_similar_keeper(cluster):
+    '''
+    Returns (keeper, others): the image with the most pixels, then the
+    largest file, then the first path
+    '''
+    keeper = max(cluster, key=lambda r: (r[4], r[1]))
+    return keeper, [r for r in cluster if r is not keeper]
+
+
+def near_duplicates(root, hash_list_path=None, max_distance=MAX_DISTANCE, jobs=1,
+                    plan_file=None, metrics=NULL_METRICS):
+    '''
+    Report the clusters of near-duplicate images of root
+
+    Nothing is deleted: near-duplicates are not identical, so the suggested
+    deletions are only written to plan_file, to be reviewed and executed with
+    `phoso.plan.apply_plan`.
+
+    Args:
+        root: directory with images
+        hash_list_path: hash index whose database also keeps the fingerprints,
+            see `phoso.index.open_index`, or None
+        max_distance: largest Hamming distance between the hashes (out of 64
+            bits) of two near-duplicates
+        jobs: number of threads decoding images
+        plan_file: if not None, a 'delete' action for each image but the
+            keeper of each cluster is written to this plan file
+        metrics: `phoso.metrics.RunMetrics`
+
+    Returns the list of (keeper, others) of the clusters
+    '''
+    index = FingerprintIndex(hash_list_path) if hash_list_path is not None else None
+    try:
+        records = fingerprint_tree(root, index, jobs, metrics)
+    finally:
+        if index is not None:
+            index.close()
+
+    with metrics.timer('similar'):
+        clusters = [choose_similar_keeper(c) for c in similar_groups(records, max_distance)]
+    metrics.add('similar', len(records))
+
+    actions = []
+    for keeper, others in clusters:
+        LOGGER.info('Keeping %s, similar: %s', keeper[0], ', '.join(r[0] for r in others))
+        actions += [('delete', r[0], keeper[0], 'similar') for r in others]
+    LOGGER.info('%s clusters of near-duplicates, %s files could be removed',
+                len(clusters), len(actions))
+
+    if plan_file is not None:
+        plan = PlanWriter(plan_file)
+        plan.write(actions)
+        plan.close()
+    return clusters
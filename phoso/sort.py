@@ -9,18 +9,138 @@ import fnmatch
 import io
 import logging
 import os
-import re
-import shutil
 import subprocess
-import sys
-from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat, tee
 from typing import Callable
-from .utils import (del_dirs, general_case_exif, match_files, move_to_hold,
-                    purge_string, rename_file)
+from .cache import MetadataCache
+from .classify import DEFAULT_CLASSIFIER, NameClassifier
+from .dest import ContentIndex, NameTable
+from .exif import exif_batch
+from .metrics import NULL_METRICS
+from .plan import Journal, PlanWriter, apply_actions
+from .utils import (THUMBNAIL_EXCLUDES, FileEntry, del_dirs, purge_string, rename_file,
+                    scan_tree)
+
+# to be increased when file_metadata gives other results for the same file,
+# so that the results of earlier versions in a metadata cache are not used
+METADATA_VERSION = 4
+
+
+def file_metadata(src_files, exif_path, ignore_exif=False, classifier=DEFAULT_CLASSIFIER):
+    '''
+    Date and camera model of each file, from the file name for the special
+    cases and from EXIF (or the video container headers) otherwise. All the
+    EXIF reads of the batch are done with a single call to `exif_batch`.
+
+    src_files may be paths or os.DirEntry, whose cached stat is used. The
+    special cases are the rules of classifier, a `phoso.classify.NameClassifier`.
+
+    Returns a list of (date, model, date_fail) in the order of src_files
+    '''
+    metadata = []
+    named = []
+    needs_exif = []
+    for src_file in src_files:
+        rule, date = classifier.classify(os.path.basename(os.fspath(src_file)))
+        named.append((rule, date))
+        if rule is None or rule.exif:
+            # general case
+            needs_exif.append(src_file)
+            metadata.append((None, None, False))
+        else:
+            metadata.append((date, rule.model, False))
+
+    exif_data = exif_batch(needs_exif, exif_path, ignore_exif=ignore_exif)
+    for i, src_file in enumerate(map(os.fspath, src_files)):
+        if src_file not in exif_data:
+            continue
+        date, model, date_fail = exif_data[src_file]
+        rule, name_date = named[i]
+        if rule is None:
+            pass
+        elif name_date is not None:
+            if model is None or date_fail:
+                date = name_date
+                model = rule.model if model is None else model
+        else:
+            # e.g. raw files without EXIF, dated by their modification time
+            model = model or rule.model
+            date_fail = False
+        metadata[i] = (date, model, date_fail)
+
+    return metadata
+
+
+def _batch_metadata(batch, exif_path, ignore_exif, cache=None, metrics=NULL_METRICS,
+                    classifier=DEFAULT_CLASSIFIER):
+    '''
+    `file_metadata` of a batch of os.DirEntry, reusing the cached metadata of
+    unchanged files and caching the others
+    '''
+    # stats are cached by the entries. On a network mount they are better
+    # taken here by the workers than one at a time when planning
+    for entry in batch:
+        try:
+            entry.stat()
+        except OSError:
+            pass
+
+    with metrics.timer('cache'):
+        cached = cache.get_many(batch) if cache is not None else {}
+    metrics.add('cache', len(cached))
+
+    misses = [entry for entry in batch if entry.path not in cached]
+    with metrics.timer('exif'):
+        cached.update(zip((entry.path for entry in misses),
+                          file_metadata(misses, exif_path, ignore_exif, classifier)))
+    metrics.add('exif', len(misses))
+    if cache is not None:
+        cache.put_many((entry, cached[entry.path]) for entry in misses)
+    return [cached[entry.path] for entry in batch]
+
+
+def _existing(paths, completed=None):
+    '''
+    Entries of the paths that still exist and are not in the journal
+    '''
+    entries = []
+    for path in paths:
+        entry = FileEntry(path)
+        try:
+            entry.stat()
+        except OSError:
+            continue
+        if completed is None or path not in completed.done:
+            entries.append(entry)
+    return entries
+
+
+def _read_ahead(func, items, depth):
+    '''
+    Yields func(item) for each item, in order. With depth > 0, a background
+    thread computes up to depth results ahead of the one being consumed
+    '''
+    if depth <= 0:
+        yield from map(func, items)
+        return
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        futures = deque()
+        for item in items:
+            futures.append(pool.submit(func, item))
+            if len(futures) > depth:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
 
 
 def sortphotos(src_dir: str, dest_dir: str, extensions: list, sort_format: str, move_files: bool, remove_duplicates: bool,
-               ignore_exif: bool, rename: Callable[[str, object, str],None], exif_path: str = '/opt/bin/exif', hold_dir: str = None):
+               ignore_exif: bool, rename: Callable[[str, object, str],None], exif_path: str = '/opt/bin/exif', hold_dir: str = None,
+               batch_size: int = 256, jobs: int = 1, hash_index: str = None, plan_file: str = None,
+               transfer: str = 'copy', metrics=None, metadata_cache: str = None, read_ahead: int = 0,
+               journal: str = None, resume: bool = False, batches=None,
+               name_rules: list = None):
     '''
 
     Args:
@@ -32,141 +152,235 @@ def sortphotos(src_dir: str, dest_dir: str, extensions: list, sort_format: str,
         remove_duplicates: True: redundant files are deleted, False redundant files are kept and renamed. File comparisons are done with `filecmp.cmp`
         ignore_exif: True: Do not attempt to use exif information of file. False: use exif information for camera model and datetime
         rename: Function for renaming files. Arguments given to the function are the source file, the datetime, and the camera model
-        exif_path: path to the local exif program. Defaults to '/opt/bin/exif'. Will be called using subprocess
+        exif_path: path to the local exif program. Defaults to '/opt/bin/exif'. exiftool is run once per batch
+            of files, any other value reads EXIF in process, see `phoso.exif.exif_batch`
         hold_dir: default None. If not none, should be a directory path where identical files are moved to instead of deleted
+        batch_size: number of files whose metadata is read in a single batch
+        jobs: number of worker threads for metadata extraction and file transfer.
+            Destination names are always assigned in source order so the result
+            does not depend on the number of jobs
+        hash_index: default None. Path to a `phoso.cull` hash index of dest_dir, created or updated if
+            needed. When given, duplicates are looked up by content anywhere in dest_dir instead of
+            being compared with `filecmp.cmp` to the file with the same name
+        plan_file: default None. If not None, nothing is created, moved or copied: the actions are written
+            to this plan file, to be executed later with `phoso.plan.apply_plan`
+        transfer: how files are copied when move_files is False, one of `phoso.transfer.METHODS`: 'copy'
+            (in-kernel copy), 'reflink' (copy-on-write clone) or 'hardlink'. 'rename' is the same as move_files.
+            Unsupported fast paths fall back to 'copy'. Moves always rename when on the same device.
+        metrics: default None. A `phoso.metrics.RunMetrics` collecting the time spent in each stage (scan, cache,
+            exif, collision, hash, mkdir, transfer) and reporting progress. Time spent hashing is part of
+            the collision time
+        metadata_cache: default None. Path to a `phoso.cache.MetadataCache` database (it may be the
+            hash index). The metadata of files unchanged since a previous run is read from it instead of
+            from EXIF
+        read_ahead: default 0. Number of chunks (batch_size * jobs files) whose metadata is read in the
+            background while the current chunk is planned and transferred. Useful when the source or
+            the destination is a network mount. Destinations are still assigned in source order
+        journal: default None. Path of a `phoso.plan.Journal` recording the transferred files after
+            each chunk. It is deleted once the run is finished
+        resume: default False. Skip the files recorded in the journal by an interrupted run. Copies
+            are written under a temporary name and renamed, so a file cut by the interruption is
+            copied again
+        batches: default None. Iterable of lists of paths of src_dir to sort, one chunk per list, instead
+            of scanning src_dir. It may block until files arrive, as `phoso.watch.Watch.batches`. Files
+            that are gone when their chunk comes are skipped, and read_ahead is not used
+        name_rules: default None. List of `phoso.classify.NameRule` giving the date and model of files
+            from their names, tried in order, see `phoso.classify.load_rules`. Defaults to the
+            built-in rules
 
 
     '''
+    if transfer == 'rename':
+        move_files = True
+
     # some error checking
     if not os.path.exists(src_dir):
         raise Exception('Source directory does not exist')
     if not os.path.exists(dest_dir):
         raise Exception('Destination directory does not exist')
 
-    matched_files = match_files(src_dir, [f'.*\.{ext}' for ext in extensions])
+    if metrics is None:
+        metrics = NULL_METRICS
 
-    # setup a progress bar
-    num_files = len(matched_files)
+    completed = Journal(journal, resume) if journal is not None and plan_file is None else None
+
+    if batches is None:
+        # entries carry their stat result, files are not stat'ed again
+        with metrics.timer('scan'):
+            matched_files = list(scan_tree(src_dir, extensions, THUMBNAIL_EXCLUDES))
+
+        metrics.add('scan', len(matched_files))
+
+        if completed is not None and completed.done:
+            matched_files = [entry for entry in matched_files if entry.path not in completed.done]
+            logging.info('Resuming, %s files left', len(matched_files))
+        num_files = len(matched_files)
+    else:
+        num_files = None
+        read_ahead = 0
     idx = 0
+    done_bytes = 0
 
-    # RE of special cases
-    r_wp_mp4 = re.compile(r'.*WP_([0-9]{8})_[0-9]{3}\.mp4')
-    r_gen_vid = re.compile(r'.*(VID|TRIM)_([0-9]{8}_[0-9]{6})\.(mp4|mkv|3gp)')
-    r_gen_img = re.compile(r'.*IMG_([0-9]{8}_[0-9]{6})\.(jpg|JPG)')
-    r_gen_mp4 = re.compile(
-        r'.*([12][890][0-9]{6}_[012][0-9][0-6][0-9][0-6][0-9])\.mp4')
-    r_gen_rw2 = re.compile(r'.+\.rw2')
-
-
-    for src_file in matched_files:
-        # update progress bar
-        numdots = int(20.0*(idx+1)/num_files)
-        sys.stdout.write('\r')
-        sys.stdout.write('[%-20s] %d of %d ' % ('='*numdots, idx+1, num_files))
-        sys.stdout.flush()
-
-        idx += 1
-        date_fail = False
-        date = None
-
-        # Special cases
-        src_basename = os.path.basename(src_file)
-        if r_wp_mp4.match(src_basename):
-            mo = r_wp_mp4.match(src_basename)
-            date = datetime.strptime(mo.groups()[0], '%Y%m%d')
-            model = 'WP'
-        elif r_gen_vid.match(src_basename):
-            mo = r_gen_vid.match(src_basename)
-            date = datetime.strptime(mo.groups()[1], '%Y%m%d_%H%M%S')
-            model = 'video'
-        elif r_gen_img.match(src_basename):
-            date, model, date_fail = general_case_exif(
-                src_file, exif_path, ignore_exif=ignore_exif)
-            if model is None or date_fail:
-                mo = r_gen_img.match(src_basename)
-                date = datetime.strptime(mo.groups()[0], '%Y%m%d_%H%M%S')
-                model = 'img' if model is None else model
-        elif r_gen_mp4.match(src_basename):
-            mo = r_gen_mp4.match(src_basename)
-            date = datetime.strptime(mo.groups()[0], '%Y%m%d_%H%M%S')
-            model = 'video'
-        elif r_gen_rw2.match(src_basename):
-            mo = r_gen_rw2.match(src_basename)
-            date = date = datetime.fromtimestamp(os.path.getmtime(src_file))
-            model = 'raw'
-
-        # General case
-        else:
-            date, model, date_fail = general_case_exif(
-                src_file, exif_path, ignore_exif=ignore_exif)
-
-        # Get rid of spaces or special characters in model
-        model = purge_string(model)
-        
-        # create folder structure
-        dir_structure = date.strftime(sort_format)
-        dirs = dir_structure.split('/')
-        dest_file = dest_dir
-        for thedir in dirs:
-            dest_file = os.path.join(dest_file, thedir)
-            if not os.path.exists(dest_file):
-                os.makedirs(dest_file)
-
-        # setup destination file
-        found_model = model
-        if rename and not date_fail:
-            new_fname = rename_file(src_file, date, model)
-            dest_file = os.path.join(dest_file, new_fname)
+    # destination file names, and content hashes to find duplicates
+    names = NameTable()
+    content = ContentIndex(dest_dir, hash_index, metrics) if hash_index and remove_duplicates else None
+
+    executor = ThreadPoolExecutor(max_workers=jobs) if jobs > 1 else None
+    plan = PlanWriter(plan_file) if plan_file is not None else None
+    chunk_size = batch_size * max(jobs, 1)
+
+    # destinations are assigned serially in source order. Transfers only
+    # start once a whole chunk is planned, so destination names claimed but
+    # not transferred yet are tracked in `claimed` (dest_file -> src_file)
+    claimed = {}
+
+    classifier = NameClassifier(name_rules) if name_rules is not None else DEFAULT_CLASSIFIER
+
+    cache = None
+    if metadata_cache is not None:
+        variant = 'ignore' if ignore_exif else ('exiftool' if 'exiftool' in exif_path else 'exif')
+        variant = '{}:{}'.format(variant, METADATA_VERSION)
+        if classifier.key:
+            variant += ':' + classifier.key
+        cache = MetadataCache(metadata_cache, variant=variant)
+
+    def chunk_metadata(chunk):
+        # metadata of a chunk, one batch per worker
+        batches = [chunk[i:i+batch_size] for i in range(0, len(chunk), batch_size)]
+        if executor is None:
+            results = [_batch_metadata(b, exif_path, ignore_exif, cache, metrics, classifier)
+                       for b in batches]
         else:
-            dest_file = os.path.join(dest_file, os.path.basename(src_file))
-        root, ext = os.path.splitext(dest_file)
-        # force extension to be lower case
-        ext = ext.lower()
-
-        # check for collisions
-        append = 1
-        file_is_identical = False
-
-        while True:
-            if os.path.isfile(dest_file):  # check for existing name
-                # check for identical files
-                if remove_duplicates and filecmp.cmp(src_file, dest_file):
-                    file_is_identical = True
-                    break
-
-                else:  # name is same, but file is different
-                    dest_file = root + '_' + str(append) + ext
-                    append += 1
+            results = executor.map(_batch_metadata, batches, repeat(exif_path), repeat(ignore_exif),
+                                   repeat(cache), repeat(metrics), repeat(classifier))
+        return [m for result in results for m in result]
+
+    if batches is None:
+        chunks = [matched_files[i:i+chunk_size] for i in range(0, num_files, chunk_size)]
+    else:
+        chunks = (_existing(batch, completed) for batch in batches)
+    chunks, ahead = tee(chunks)
+    for chunk, metadata in zip(chunks, _read_ahead(chunk_metadata, ahead, read_ahead)):
+        if cache is not None:
+            cache.commit()
+        if batches is not None:
+            # files may have been written to dest_dir since the last batch
+            names.clear()
 
+        # folder structure, created with the transfers
+        dest_dirs = [os.path.join(dest_dir, *date.strftime(sort_format).split('/'))
+                     for date, _, _ in metadata]
+        if executor is not None:
+            names.prefetch(dest_dirs, executor)
+
+        actions = []
+        transfer_bytes = 0
+        for entry, (date, model, date_fail), dest_file in zip(chunk, metadata, dest_dirs):
+            src_file = entry.path
+            idx += 1
+            # Get rid of spaces or special characters in model
+            model = purge_string(model)
+
+            # setup destination file
+            found_model = model
+            if rename and not date_fail:
+                new_fname = rename_file(src_file, date, model)
+                dest_file = os.path.join(dest_file, new_fname)
             else:
-                break
-
-        # finally move or copy the file
-        if move_files:
-            if file_is_identical:
-                if hold_dir is not None:
-                    hold_file = move_to_hold(src_dir, hold_dir, src_file)
-                    logging.info('{}, {}, hold moved as it is identical, {}, {}'.format(
-                        src_file, hold_file, date, found_model))
+                dest_file = os.path.join(dest_file, os.path.basename(src_file))
+            root, ext = os.path.splitext(dest_file)
+            # force extension to be lower case
+            ext = ext.lower()
+
+            # check for collisions
+            append = 1
+            file_is_identical = False
+            src_hash = None
+            with metrics.timer('collision'):
+                if remove_duplicates and content is not None:
+                    # look for an identical file anywhere in dest_dir
+                    fsize = entry.stat().st_size
+                    identical_file, src_hash = content.find(src_file, fsize)
+                    if identical_file is not None:
+                        file_is_identical = True
+                        dest_file = identical_file
+
+                while not file_is_identical and names.exists(dest_file):  # check for existing name
+                    # check for identical files, a name claimed but not
+                    # transferred yet is compared with the file that will go there
+                    if remove_duplicates and content is None and \
+                            filecmp.cmp(src_file, claimed.get(dest_file, dest_file)):
+                        file_is_identical = True
+                        break
+
+                    else:  # name is same, but file is different
+                        dest_file = root + '_' + str(append) + ext
+                        append += 1
+            metrics.add('collision')
+
+            # finally move or copy the file
+            reason = 'collision' if append > 1 else 'new'
+            if move_files:
+                if file_is_identical:
+                    if hold_dir is not None:
+                        hold_file = os.path.join(hold_dir, os.path.relpath(src_file, src_dir))
+                        logging.info('{}, {}, hold moved as it is identical, {}, {}'.format(
+                            src_file, hold_file, date, found_model))
+                        actions.append(('hold', src_file, hold_file, 'identical'))
+                    else:
+                        logging.info('{}, {}, not moved as it is identical, {}, {}'.format(
+                            src_file, dest_file, date, found_model))
+                        actions.append(('skip', src_file, dest_file, 'identical'))
+                    continue  # if file is same, we just ignore it
+
                 else:
-                    logging.info('{}, {}, not moved as it is identical, {}, {}'.format(
+                    logging.info('{}, {}, moved to, {}, {}'.format(
                         src_file, dest_file, date, found_model))
-                continue  # if file is same, we just ignore it
-
-            else:
-                logging.info('{}, {}, moved to, {}, {}'.format(
-                    src_file, dest_file, date, found_model))
-                shutil.move(src_file, dest_file)
-        else:
-            if file_is_identical:
-                logging.info('{}, {}, not copied as it is identical, {}, {}'.format(
-                    src_file, dest_file, date, found_model))
-                # if file is same, we just ignore it (for copy option)
-                continue
+                    actions.append(('move', src_file, dest_file, reason))
             else:
-                logging.info('{}, {}, copied, {}, {}'.format(
-                    src_file, dest_file, date, found_model))
-                shutil.copy2(src_file, dest_file)
+                if file_is_identical:
+                    logging.info('{}, {}, not copied as it is identical, {}, {}'.format(
+                        src_file, dest_file, date, found_model))
+                    # if file is same, we just ignore it (for copy option)
+                    actions.append(('skip', src_file, dest_file, 'identical'))
+                    continue
+                else:
+                    logging.info('{}, {}, copied, {}, {}'.format(
+                        src_file, dest_file, date, found_model))
+                    actions.append((transfer, src_file, dest_file, reason))
+            claimed[dest_file] = src_file
+            transfer_bytes += entry.stat().st_size
+            names.claim(dest_file)
+            if content is not None:
+                content.add(dest_file, src_file, entry.stat().st_size, src_hash)
+
+        if plan is not None:
+            # nothing is transferred, names stay claimed for the whole run
+            plan.write(actions)
+            metrics.progress(idx, num_files)
+            continue
+
+        # execute the transfers of the chunk
+        # actions are journaled as they complete, a crash mid-chunk only redoes the unfinished ones
+        apply_actions(actions, executor, metrics, names.existing,
+                      completed.add if completed is not None else None)
+        if completed is not None:
+            completed.sync()
+        metrics.add('transfer', 0, transfer_bytes)
+        done_bytes += transfer_bytes
+        claimed.clear()
+        if content is not None:
+            content.flush()
+        metrics.progress(idx, num_files, done_bytes)
+
+    if plan is not None:
+        plan.close()
+    if executor is not None:
+        executor.shutdown()
+    if content is not None:
+        content.close()
+    if cache is not None:
+        cache.close()
+    if completed is not None:
+        completed.close()
 
-    # Print a newline to move below the progress bar
-    print()
@@ -0,0 +1,191 @@
+"""
+transfer.py
+
+File transfer backends. Every method falls back to the next cheaper one that
+works when the fast path is not supported by the OS or the file system:
+
+- 'rename': os.rename on the same device, copy then delete otherwise
+- 'reflink': FICLONE copy-on-write clone (btrfs, XFS), else 'copy'
+- 'hardlink': os.link, else 'copy'
+- 'copy': in-kernel copy with os.copy_file_range or os.sendfile, else a
+  userspace copy. File metadata is copied as with shutil.copy2
+
+Copies are written under a temporary name next to the destination and
+renamed once complete, so that an interrupted run never leaves a truncated
+file under the destination name.
+
+No method replaces an existing destination: they raise FileExistsError, so
+that the caller can pick another name.
+"""
+
+import errno
+import logging
+import os
+import shutil
+
+LOGGER = logging.getLogger(__name__)
+
+METHODS = ['copy', 'reflink', 'hardlink', 'rename']
+
+# ioctl request of linux/fs.h FICLONE
+FICLONE = 0x40049409
+
+_CHUNK = 1 << 30
+
+# suffix of the temporary files, which are also hidden
+TMP_SUFFIX = '.phoso-tmp'
+
+
+def _copy_range(fin, fout):
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    if copy_file_range is not None:
+        try:
+            while copy_file_range(fin, fout, _CHUNK):
+                pass
+            return
+        except OSError as ex:
+            if ex.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+            # nothing was written if the call is not supported at all
+            if os.lseek(fout, 0, os.SEEK_CUR):
+                raise
+    if hasattr(os, 'sendfile'):
+        try:
+            offset = 0
+            while True:
+                sent = os.sendfile(fout, fin, offset, _CHUNK)
+                if not sent:
+                    return
+                offset += sent
+        except OSError as ex:
+            if ex.errno not in (errno.ENOSYS, errno.EINVAL) or offset:
+                raise
+    with os.fdopen(os.dup(fin), 'rb') as src, os.fdopen(os.dup(fout), 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+
+
+def temp_name(dest_file):
+    """
+    Temporary name a file is written under before being renamed to dest_file
+    """
+    dirname, fname = os.path.split(dest_file)
+    return os.path.join(dirname, '.' + fname + TMP_SUFFIX)
+
+
+def _exists_error(dest_file):
+    return FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), dest_file)
+
+
+def _rename_no_replace(src_file, dest_file):
+    '''
+    Rename src_file to dest_file, raise FileExistsError if dest_file exists
+
+    A hard link fails atomically when dest_file exists. On file systems
+    without hard links, dest_file is checked just before the rename.
+    '''
+    try:
+        os.link(src_file, dest_file, follow_symlinks=False)
+    except FileExistsError:
+        raise
+    except OSError as ex:
+        if ex.errno == errno.EXDEV:
+            raise
+        if os.path.lexists(dest_file):
+            raise _exists_error(dest_file)
+        os.rename(src_file, dest_file)
+        return
+    os.unlink(src_file)
+
+
+def _via_temp(func, src_file, dest_file):
+    if os.path.lexists(dest_file):
+        # nothing to copy
+        raise _exists_error(dest_file)
+    tmp_file = temp_name(dest_file)
+    try:
+        func(src_file, tmp_file)
+        _rename_no_replace(tmp_file, dest_file)
+    except BaseException:
+        try:
+            os.unlink(tmp_file)
+        except OSError:
+            pass
+        raise
+
+
+def _copy(src_file, dest_file):
+    with open(src_file, 'rb') as fin, open(dest_file, 'wb') as fout:
+        _copy_range(fin.fileno(), fout.fileno())
+    shutil.copystat(src_file, dest_file)
+
+
+def copy_file(src_file, dest_file):
+    """
+    Copy data and metadata without moving the bytes through userspace when possible
+    """
+    _via_temp(_copy, src_file, dest_file)
+
+
+def _reflink(src_file, dest_file):
+    import fcntl
+    with open(src_file, 'rb') as fin, open(dest_file, 'wb') as fout:
+        fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+    shutil.copystat(src_file, dest_file)
+
+
+def reflink_file(src_file, dest_file):
+    """
+    Copy-on-write clone of src_file, falls back to copy_file
+    """
+    try:
+        _via_temp(_reflink, src_file, dest_file)
+    except FileExistsError:
+        raise
+    except (ImportError, OSError) as ex:
+        LOGGER.debug('%s: reflink failed, copying: %s', src_file, ex)
+        copy_file(src_file, dest_file)
+
+
+def link_file(src_file, dest_file):
+    """
+    Hard link dest_file to src_file, falls back to copy_file
+    """
+    try:
+        os.link(src_file, dest_file)
+    except FileExistsError:
+        raise
+    except OSError as ex:
+        LOGGER.debug('%s: hardlink failed, copying: %s', src_file, ex)
+        copy_file(src_file, dest_file)
+
+
+def move_file(src_file, dest_file):
+    """
+    Rename src_file, copy then delete it when crossing devices
+    """
+    try:
+        _rename_no_replace(src_file, dest_file)
+    except FileExistsError:
+        raise
+    except OSError as ex:
+        if ex.errno != errno.EXDEV:
+            raise
+        copy_file(src_file, dest_file)
+        os.unlink(src_file)
+
+
+_BACKENDS = {
+    'copy': copy_file,
+    'reflink': reflink_file,
+    'hardlink': link_file,
+    'rename': move_file,
+}
+
+
+def transfer(src_file, dest_file, method='copy'):
+    """
+    Transfer src_file to dest_file with one of METHODS
+
+    Raises FileExistsError if dest_file exists
+    """
+    _BACKENDS[method](src_file, dest_file)
@@ -3,10 +3,9 @@ import logging
 import os
 import re
 import shutil
-import subprocess
-from subprocess import PIPE
-import sys
-from datetime import datetime
+
+from .exif import exif_batch
+from .transfer import transfer
 
 # -------- convenience methods -------------
 
@@ -18,28 +17,6 @@ def purge_string(s):
         return ''
 
 
-def cmd_exiftool(tag, fname, command):
-    sp = subprocess.run([command,'-s','-S',f'-{tag}',fname], stdout=PIPE, stderr=PIPE)
-    out = sp.stdout.decode().strip()
-    err_val = sp.stderr.decode().strip()
-    if err_val:
-        msg = '{}: EXIF failed with error: {}'.format(fname, err_val)
-        logging.debug(msg)
-        raise ValueError(msg)
-    return out
-
-
-def cmd_exif(tag, fname, command="/opt/bin/exif"):
-    # out = subprocess.check_output([command,'-m','-t',tag,fname]).decode().strip()
-    sp = subprocess.run([command,'-m','-t',tag,fname], stdout=PIPE, stderr=PIPE)
-    out = sp.stdout.decode().strip()
-    err_val = sp.stderr.decode().strip()
-    if err_val:
-        msg = '{}: EXIF failed with error: {}'.format(fname, err_val)
-        logging.debug(msg)
-        raise ValueError(msg)
-    return out
-
 def del_dirs(src_dir,force=False, match=None):
     for dirpath, _, _ in os.walk(src_dir, topdown=False):  # Listing the files
         if dirpath == src_dir:
@@ -56,96 +33,111 @@ def del_dirs(src_dir,force=False, match=None):
                 os.rmdir(dirpath)
                 logging.info('rmdir: {}'.format(dirpath))
         except OSError as ex:
-            sys.stderr.write(str(ex))
+            logging.warning(str(ex))
             
 def general_case_exif(src_file, exif_path, ignore_exif=False):
     # use file time stamp if no valid EXIF dataa
-    date = None
-    date_fail = False
-    if ignore_exif:
-        date = datetime.fromtimestamp(os.path.getmtime(src_file))
-        model = None
-
-    else:
-        # look for date in EXIF data
-        if 'exiftool' in exif_path:
-            # use exiftool syntax (windows)
-            date_tags = ['DateTimeCreated', 'DateTimeOriginal', 'CreateDate']
-            exif_function = cmd_exiftool
-        else:
-            # assume standard linux exif
-            date_tags = ['Date and Time (Original)', 'Date and Time (Digitized)', 'Date and Time']
-            exif_function = cmd_exif
-
-        for tag in date_tags:
-            try:
-                date_str = exif_function(tag, src_file, exif_path)
-                date = datetime.strptime(date_str,"%Y:%m:%d %H:%M:%S")
-                break
-            except:
-                pass
-
-        if date is None:
-            date = datetime.fromtimestamp(os.path.getmtime(src_file))
-            date_fail = True
-            
-
-        # look for model in EXIF data
-        try:
-            model = exif_function('Model', src_file, exif_path)
-        except:
-            model = None
-            
-    return date, model, date_fail
+    # single file version of exif_batch, prefer the latter for many files
+    return exif_batch([src_file], exif_path, ignore_exif=ignore_exif)[src_file]
 
-def move_to_hold(src_dir, hold_dir, fpath):
+def move_to_hold(src_dir, hold_dir, fpath, method='rename'):
+    # method is one of phoso.transfer.METHODS, 'rename' moves the file
     new_fpath = os.path.join(hold_dir, os.path.relpath(fpath, src_dir))
     new_dir = os.path.dirname(new_fpath)
     if not os.path.isdir(new_dir):
         os.makedirs(new_dir)
-    shutil.move(fpath, new_fpath)
+    transfer(fpath, new_fpath, method)
     return new_fpath        
 
-def match_files(src_dir, includes, excludes=[], ignore_case=True):
-
-    # find files that have the specified extensions
-    matched_files = []
-
+def _fold_case(ignore_case):
     # check if file system is case sensitive
     case_sensitive_os = True
     if os.path.normcase('A') == os.path.normcase('a'):
         case_sensitive_os = False
+    return case_sensitive_os or ignore_case
+
+
+def scan_tree(src_dir, extensions=None, excludes=[], ignore_case=True):
+    """
+    Recursively scan src_dir with os.scandir and yield the os.DirEntry of
+    each matching file, in the same order as os.walk. The entries cache their
+    stat result, call entry.stat() rather than os.stat(entry.path).
+
+    Args:
+        src_dir: directory to scan
+        extensions: extensions to keep, without period. None keeps every file
+        excludes: regular expressions, files and directories whose name
+            matches are skipped, directories without being descended into
+        ignore_case: match extensions and excludes regardless of case
+    """
+    fold = _fold_case(ignore_case)
+    flags = re.IGNORECASE if fold else 0
+    r_exs = [re.compile(x, flags) for x in excludes]
+    if extensions is not None:
+        extensions = {x.lower() if fold else x for x in extensions}
+
+    stack = [src_dir]
+    while stack:
+        subdirs = []
+        try:
+            with os.scandir(stack.pop()) as it:
+                entries = list(it)
+        except OSError as ex:
+            logging.debug('Could not scan: {}'.format(ex))
+            continue
+        for entry in entries:
+            if any(r_ex.match(entry.name) for r_ex in r_exs):
+                continue
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    subdirs.append(entry.path)
+                continue
+            if extensions is not None:
+                _, dot, ext = entry.name.rpartition('.')
+                if not dot or (ext.lower() if fold else ext) not in extensions:
+                    continue
+            yield entry
+        # walk the subdirectories in listing order
+        stack.extend(reversed(subdirs))
+
+
+class FileEntry:
+    """
+    Entry of a file known by its path, with the path, name and cached stat()
+    of an os.DirEntry, for the files that do not come from os.scandir
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        self._stat = None
+
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+    def __fspath__(self):
+        return self.path
+
+
+# Linux thumbnails are generated with @ in the filename, or in .@__thumb folders
+THUMBNAIL_EXCLUDES = ['.*@']
 
-    # compile regular expressions
-    if case_sensitive_os or ignore_case:
-        r_ins = [re.compile(i, re.IGNORECASE) for i in includes]
-        r_exs = [re.compile(x, re.IGNORECASE) for x in excludes]
-    else:
-        r_ins = [re.compile(i) for i in includes]
-        r_exs = [re.compile(x) for x in excludes]
-
-    # recurvsively search directory
-    for root, dirnames, filenames in os.walk(src_dir):
-        for f in filenames:
-            exclude = False            
-            # Break loop if regex_exlude matches
-            for r_ex in r_exs:
-                if r_ex.match():
-                    exclude = True
-                    break
-            if exclude:
-                break
-
-            # Keep file and break if regex_include matches
-            for r_in in r_ins:
-                if r_in.match(f):
-                    matched_files.append(os.path.join(root, f))
-                    break
-
-    # Linux thumbnails are generated with @ in the filename
-    matched_files = [x for x in matched_files if "@" not in x]
-
-    return matched_files
+
+def match_files(src_dir, includes, excludes=[], ignore_case=True):
+    """
+    Paths of the files of src_dir whose name matches one of the includes
+    regular expressions, see `scan_tree`. Linux thumbnails, with @ in their
+    name or in the name of their directory, are skipped.
+    """
+    flags = re.IGNORECASE if _fold_case(ignore_case) else 0
+    r_ins = [re.compile(i, flags) for i in includes]
+
+    excludes = list(excludes) + THUMBNAIL_EXCLUDES
+
+    return [entry.path for entry in scan_tree(src_dir, excludes=excludes, ignore_case=ignore_case)
+            if any(r_in.match(entry.name) for r_in in r_ins)]
 
 
 def rename_file(src_file, date, model):
@@ -0,0 +1,292 @@
+"""
+watch.py
+
+New files of a directory tree, for sorting them as they arrive.
+
+On Linux the tree is watched with inotify, through ctypes: the process sleeps
+in select() until the kernel reports a file closed after writing or moved
+into the tree, so an idle watch costs no CPU. Elsewhere, or when inotify is
+not available, the tree is scanned every poll interval instead.
+
+A reported file is only handed over once it has settled: no new event for
+settle seconds and the same size as when last reported. Uploads that close
+and reopen a file, or copies still running when the tree is polled, are
+waited for.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import re
+import select
+import struct
+import time
+
+from .utils import THUMBNAIL_EXCLUDES, _fold_case, scan_tree
+
+LOGGER = logging.getLogger(__name__)
+
+# inotify events, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+_EVENT = struct.Struct('iIII')
+
+SETTLE = 2.0
+POLL_INTERVAL = 10.0
+
+
+def _libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class InotifyWatcher:
+    """
+    Recursive inotify watch of root. New subdirectories are watched as they
+    are created, and the files they already hold are reported.
+
+    Raises OSError if inotify is not available
+    """
+
+    def __init__(self, root, excludes=THUMBNAIL_EXCLUDES, ignore_case=True):
+        self.libc = _libc()
+        if self.libc is None:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        flags = re.IGNORECASE if _fold_case(ignore_case) else 0
+        self.r_exs = [re.compile(x, flags) for x in excludes]
+        self.root = root
+        # watch descriptor -> directory
+        self.dirs = {}
+        # files of root are there before the watch starts
+        self.add_tree(root)
+
+    def _excluded(self, name):
+        return any(r_ex.match(name) for r_ex in self.r_exs)
+
+    def add_tree(self, top):
+        '''
+        Watch top and its subdirectories. Each directory is watched before
+        it is listed so that no file slips between the two.
+
+        Returns the paths of the files found
+        '''
+        files = []
+        stack = [top]
+        while stack:
+            dirpath = stack.pop()
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath), WATCH_MASK)
+            if wd < 0:
+                LOGGER.warning('Could not watch %s: %s', dirpath, os.strerror(ctypes.get_errno()))
+                continue
+            self.dirs[wd] = dirpath
+            try:
+                with os.scandir(dirpath) as it:
+                    entries = list(it)
+            except OSError as ex:
+                LOGGER.debug('Could not scan: %s', ex)
+                continue
+            for entry in entries:
+                if self._excluded(entry.name):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    files.append(entry.path)
+        return files
+
+    def events(self, timeout=None):
+        '''
+        Wait up to timeout seconds, forever if None, for files to be written
+        or moved into the tree
+
+        Returns the list of their paths. If the kernel queue overflowed,
+        events were lost and every file of the tree is returned
+        '''
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                LOGGER.warning('inotify queue overflow, rescanning %s', self.root)
+                return [entry.path for entry in scan_tree(self.root)]
+            if mask & IN_IGNORED:
+                # directory deleted or moved away
+                self.dirs.pop(wd, None)
+                continue
+            dirpath = self.dirs.get(wd)
+            if dirpath is None or self._excluded(name):
+                continue
+            path = os.path.join(dirpath, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    paths += self.add_tree(path)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                paths.append(path)
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """
+    Watch of root by scanning it every interval seconds. A file is reported
+    when it appears or its size or mtime changed since the previous scan.
+    """
+
+    def __init__(self, root, interval=POLL_INTERVAL, excludes=THUMBNAIL_EXCLUDES,
+                 ignore_case=True):
+        self.root = root
+        self.interval = interval
+        self.excludes = excludes
+        self.ignore_case = ignore_case
+        self.next_scan = time.monotonic() + interval
+        # files of root are there before the watch starts
+        self.seen = self._scan()
+
+    def _scan(self):
+        seen = {}
+        for entry in scan_tree(self.root, None, self.excludes, self.ignore_case):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            seen[entry.path] = (stat.st_size, stat.st_mtime)
+        return seen
+
+    def events(self, timeout=None):
+        wait = self.next_scan - time.monotonic()
+        if timeout is not None and timeout < wait:
+            time.sleep(max(timeout, 0))
+            return []
+        time.sleep(max(wait, 0))
+        self.next_scan = time.monotonic() + self.interval
+        seen = self._scan()
+        paths = [path for path, key in seen.items() if self.seen.get(path) != key]
+        self.seen = seen
+        return paths
+
+    def close(self):
+        pass
+
+
+def _size(path):
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return None
+
+
+class Watch:
+    """
+    New files of src_dir, handed over in lists once they are complete.
+
+    The watch starts when the object is created: files already in src_dir
+    are not reported, files written from then on are, even before `batches`
+    is called.
+
+    Args:
+        src_dir: directory watched recursively
+        extensions: extensions to keep, without period. None keeps every file
+        excludes: regular expressions, files and directories whose name
+            matches are skipped
+        settle: seconds without event and size change after which a file is
+            considered complete
+        batch_size: largest number of files in a list
+        poll_interval: if not None, scan src_dir every poll_interval seconds
+            instead of using inotify
+        ignore_case: match extensions and excludes regardless of case
+    """
+
+    def __init__(self, src_dir, extensions=None, excludes=THUMBNAIL_EXCLUDES, settle=SETTLE,
+                 batch_size=256, poll_interval=None, ignore_case=True):
+        self.src_dir = os.path.abspath(src_dir)
+        self.fold = _fold_case(ignore_case)
+        self.extensions = None
+        if extensions is not None:
+            self.extensions = {x.lower() if self.fold else x for x in extensions}
+        self.settle = settle
+        self.batch_size = batch_size
+
+        self.watcher = None
+        if poll_interval is None:
+            try:
+                self.watcher = InotifyWatcher(self.src_dir, excludes, ignore_case)
+            except OSError as ex:
+                LOGGER.warning('Falling back to polling: %s', ex)
+        if self.watcher is None:
+            self.watcher = PollingWatcher(self.src_dir, poll_interval or POLL_INTERVAL,
+                                          excludes, ignore_case)
+        LOGGER.info('Watching %s with %s', self.src_dir, type(self.watcher).__name__)
+        # path -> (time it settles, size when last reported)
+        self.pending = {}
+
+    def _wanted(self, path):
+        if self.extensions is None:
+            return True
+        _, dot, ext = os.path.basename(path).rpartition('.')
+        return bool(dot) and (ext.lower() if self.fold else ext) in self.extensions
+
+    def _settled(self):
+        now = time.monotonic()
+        ready = []
+        for path, (settled, size) in list(self.pending.items()):
+            if settled > now:
+                continue
+            current = _size(path)
+            if current is None:
+                # gone before it settled
+                del self.pending[path]
+            elif current != size:
+                self.pending[path] = (now + self.settle, current)
+            else:
+                del self.pending[path]
+                ready.append(path)
+        return sorted(ready)
+
+    def batches(self):
+        '''
+        Yields lists of complete new files, forever. Between events the
+        process sleeps
+        '''
+        while True:
+            timeout = None
+            if self.pending:
+                timeout = max(min(t for t, _ in self.pending.values()) - time.monotonic(), 0)
+            paths = self.watcher.events(timeout)
+            now = time.monotonic()
+            for path in paths:
+                if self._wanted(path):
+                    self.pending[path] = (now + self.settle, _size(path))
+            ready = self._settled()
+            for i in range(0, len(ready), self.batch_size):
+                yield ready[i:i+self.batch_size]
+
+    def close(self):
+        self.watcher.close()